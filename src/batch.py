@@ -0,0 +1,130 @@
+"""
+Fit many specifications on the same panel at once
+Specifications that share a model, time effects and estimation sample are served from
+one transform of the union of their variables and one shared cross-product matrix,
+every model's solve uses a sub-block of it
+"""
+
+import numpy as np
+
+from crossprod import CrossProducts, ols_results
+from panel_data import PanelData
+from panel_store import PanelStore
+from transforms import entity_demean, first_difference, twoway_demean
+
+
+def _normalize(spec):
+    """
+    Turn a specification into a (model, time, y, x) tuple
+    :param spec: dict with keys 'y', 'x' and optionally 'model' ('fe' or 'fd') and 'time', or a (y, x) tuple
+    :return: tuple
+    """
+
+    if type(spec) is dict:
+        y, x = spec['y'], spec['x']
+        model, time = spec.get('model', 'fe'), spec.get('time', False)
+    else:
+        y, x = spec
+        model, time = 'fe', False
+
+    if type(x) is str:
+        x = [x]
+
+    assert model in ('fe', 'fd')
+    assert not (model == 'fd' and time)
+    assert y not in x
+
+    return model, bool(time), y, tuple(x)
+
+
+def _transform(data, mask, model, time):
+    """
+    Transform all variables of a group of specifications on their common sample
+    :param data: 3D array (entities * times * variables)
+    :param mask: 2D boolean array of the common sample
+    :param model: 'fe' or 'fd'
+    :param time: whether to include time effects
+    :return: 3D array of transformed data
+    """
+
+    if model == 'fd':
+        data = data.copy()
+        data[~mask] = np.nan
+        return first_difference(data)
+    if time:
+        return twoway_demean(data, mask)
+    return entity_demean(data, mask)
+
+
+def _absorbed(mask, model, time):
+    """
+    Count the effects absorbed by the transform of a group of specifications
+    :param mask: 2D boolean array of the common sample
+    :param model: 'fe' or 'fd'
+    :param time: whether to include time effects
+    :return: dict of dimension name -> number of effects
+    """
+
+    if model == 'fd':
+        return {}
+
+    absorbed = {'entity': int(mask.any(axis=1).sum())}
+    if time:
+        absorbed['time'] = int(mask.any(axis=0).sum()) - 1
+    return absorbed
+
+
+def fit_many(panel, specs, cov_type='nonrobust'):
+    """
+    Estimate a list of FE / FD specifications, transforming each variable once per sample
+    :param panel: PanelData, or PanelStore of which only the variables of the specifications are read
+    :param specs: list of specifications, each a dict {'y': depvar, 'x': indvars, 'model': 'fe' or 'fd', 'time': bool}
+    or a (y, x) tuple for one-way fixed effects
+    :param cov_type: 'nonrobust' or 'robust' (HC1)
+    :return: list of PanelResults, in the order of specs
+    """
+
+    assert type(panel) in (PanelData, PanelStore)
+    assert cov_type in ('nonrobust', 'robust')
+
+    specs = [_normalize(spec) for spec in specs]
+
+    if type(panel) is PanelStore:
+        panel = panel.load([variable for spec in specs for variable in (spec[2],) + spec[3]])
+
+    # observed cells of every variable used, computed once
+    used = sorted(set(variable for spec in specs for variable in (spec[2],) + spec[3]), key=panel.position)
+    column = dict((variable, position) for position, variable in enumerate(used))
+    observed = np.isfinite(panel.select(used))  # select already blanks cells outside the panel's mask
+
+    # group specifications by model, time effects and estimation sample
+    groups = {}
+    masks = {}
+    for position, (model, time, y, x) in enumerate(specs):
+        mask = observed[:, :, [column[variable] for variable in (y,) + x]].all(axis=2)
+        key = (model, time, mask.tobytes())
+        masks[key] = mask
+        groups.setdefault(key, []).append(position)
+
+    results = [None] * len(specs)
+    for key, positions in groups.items():
+        model, time, _ = key
+        variables = sorted(set(variable for position in positions for variable in (specs[position][2],) + specs[position][3]), key=panel.position)
+        index = dict((variable, position) for position, variable in enumerate(variables))
+
+        transformed = _transform(panel.select(variables), masks[key], model, time)
+        shared = CrossProducts.from_array(transformed)
+        absorbed = _absorbed(masks[key], model, time)
+
+        for position in positions:
+            _, _, y, x = specs[position]
+            columns = [index[variable] for variable in (y,) + x]
+
+            products = CrossProducts(len(x))
+            products.zz = shared.zz[np.ix_(columns, columns)]
+            products.nobs = shared.nobs
+
+            data = transformed[:, :, columns] if cov_type == 'robust' else None
+            results[position] = ols_results(products, y, list(x), cov_type, data, absorbed=absorbed)
+
+    return results
@@ -0,0 +1,286 @@
+"""
+Benchmark suite for the panel builder and the estimators
+Generates synthetic panels over a grid of entities, times, regressors and missingness rates,
+times every phase separately (build, and the instrumented select, transform, design/cross-products and
+solve phases of the estimator classes), records peak memory and writes machine-readable JSON,
+optionally compared against a stored baseline
+
+Usage:
+python benchmark.py --entities 100,1000 --times 20,50 --k 3,7 --missing 0,0.3 --output bench.json
+python benchmark.py --baseline bench.json --tolerance 1.25
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from first_diff import FirstDiff
+from fixed_effects import FixedEffects
+from instrument import Instrumentation
+from panel_builder import PanelBuilder
+from panel_data import PanelData
+from transform_cache import TransformCache
+
+
+def synthetic_panel(n_entities, n_times, k, missing=0., seed=0):
+    """
+    Generate a panel with entity and time effects and a known linear model
+    :param n_entities: number of entities
+    :param n_times: number of periods
+    :param k: number of regressors
+    :param missing: share of (entity, time) cells that are missing
+    :param seed: random seed
+    :return: PanelData with variables y, x0 .. x(k-1)
+    """
+
+    rng = np.random.RandomState(seed)
+
+    entity_effects = rng.normal(size=(n_entities, 1, 1))
+    time_effects = rng.normal(size=(1, n_times, 1))
+
+    x = rng.normal(size=(n_entities, n_times, k)) + entity_effects + time_effects
+    beta = np.linspace(-1., 1., k)
+    y = np.dot(x, beta) + entity_effects[:, :, 0] + time_effects[:, :, 0] + rng.normal(size=(n_entities, n_times))
+
+    values = np.concatenate([y[:, :, np.newaxis], x], axis=2)
+    if missing > 0:
+        values[rng.uniform(size=(n_entities, n_times)) < missing] = np.nan
+
+    return PanelData(values, variables=['y'] + ['x%d' % j for j in range(k)])
+
+
+def _measure(function, repeat):
+    """
+    Best wall time over repeats, then peak traced memory of one more run
+    :param function: callable without arguments
+    :param repeat: number of timed runs
+    :return: tuple of (seconds, peak bytes, return value of the last run)
+    """
+
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return best, peak, value
+
+
+def _quiet(function):
+    """
+    Wrap a function so that its prints are swallowed
+    :param function: callable without arguments
+    :return: callable
+    """
+
+    def wrapped():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return function()
+    return wrapped
+
+
+def build_cases(panel):
+    """
+    Construction paths of the PanelBuilder
+    :param panel: PanelData to rebuild
+    :return: dict of name -> callable
+    """
+
+    values = panel.values
+    by_time = [pd.DataFrame(values[:, position, :], columns=panel.variables) for position in range(values.shape[1])]
+    by_entity = [pd.DataFrame(values[position], columns=panel.variables) for position in range(values.shape[0])]
+    long_frame = panel.to_frame(dropna=True).reset_index()
+
+    def from_array():
+        builder = PanelBuilder()
+        builder.panel_from_array(values)
+        return builder.save_panel()
+
+    def from_time():
+        builder = PanelBuilder()
+        builder.frames_by_time(False, True, *by_time)
+        return builder.save_panel()
+
+    def from_entity():
+        builder = PanelBuilder()
+        builder.frames_by_entity(False, True, *by_entity)
+        return builder.save_panel()
+
+    def from_long():
+        return PanelBuilder().panel_from_long(long_frame, 'entity', 'time')
+
+    return {
+        'build/array': _quiet(from_array),
+        'build/frames_by_time': _quiet(from_time),
+        'build/frames_by_entity': _quiet(from_entity),
+        'build/long': _quiet(from_long),
+    }
+
+
+def estimator_cases(panel):
+    """
+    The FE (one-way, two-way, iterative, cached) and FD estimators, built and estimated end to end
+    :param panel: PanelData with variables y, x0 ..
+    :return: list of (model name, callable taking an Instrumentation and returning the estimator)
+    """
+
+    names = panel.variables.tolist()[1:]
+    cache = TransformCache()  # warmed by the first run, later runs time the cache hits
+
+    return [
+        ('fe', lambda instrument: FixedEffects(panel, 'y', names, instrument=instrument)),
+        ('fe_time', lambda instrument: FixedEffects(panel, 'y', names, True, instrument=instrument)),
+        ('fe_iterative', lambda instrument: FixedEffects(panel, 'y', names, True, iterative=True, instrument=instrument)),
+        ('fe_cached', lambda instrument: FixedEffects(panel, 'y', names, cache=cache, instrument=instrument)),
+        ('fd', lambda instrument: FirstDiff(panel, 'y', names, instrument=instrument)),
+    ]
+
+
+def _estimator_phases(build, memory):
+    """
+    Construct and estimate one model under instrumentation
+    :param build: callable taking an Instrumentation and returning the estimator
+    :param memory: whether to trace allocations
+    :return: dict of phase name -> summed record, from construction (select) to the solve
+    """
+
+    instrument = Instrumentation(memory=memory)
+    build(instrument).estimate('crossprod')
+    return instrument.totals()
+
+
+def run_case(n_entities, n_times, k, missing, repeat=3, seed=0):
+    """
+    Benchmark every phase on one panel shape
+    :param n_entities: number of entities
+    :param n_times: number of periods
+    :param k: number of regressors
+    :param missing: share of missing cells
+    :param repeat: number of timed runs per phase
+    :param seed: random seed
+    :return: list of result dicts
+    """
+
+    panel = synthetic_panel(n_entities, n_times, k, missing, seed)
+    shape = {'entities': n_entities, 'times': n_times, 'k': k, 'missing': missing}
+
+    records = []
+
+    def record(phase, seconds, peak, **extra):
+        entry = dict(shape)
+        entry.update({'phase': phase, 'seconds': seconds, 'peak_bytes': peak})
+        entry.update(extra)
+        records.append(entry)
+
+    for phase, function in sorted(build_cases(panel).items()):
+        seconds, peak, _ = _measure(function, repeat)
+        record(phase, seconds, peak)
+
+    for model, build in estimator_cases(panel):
+        # timed without tracing, the best run per phase is kept
+        best = {}
+        for _ in range(repeat):
+            for phase, totals in _estimator_phases(build, False).items():
+                best[phase] = min(best.get(phase, np.inf), totals['seconds'])
+
+        # one traced run for the allocations and copies of every phase
+        for phase, totals in _estimator_phases(build, True).items():
+            record(model + '/' + phase, best[phase], totals['allocated_bytes'],
+                   copies=totals['copies'], copied_bytes=totals['copied_bytes'])
+
+    return records
+
+
+def _key(record):
+    return (record['entities'], record['times'], record['k'], record['missing'], record['phase'])
+
+
+def compare(records, baseline, tolerance, min_seconds=1e-3):
+    """
+    Find phases that got slower than the baseline
+    :param records: list of result dicts
+    :param baseline: list of result dicts of a previous run
+    :param tolerance: allowed ratio of new over baseline seconds
+    :param min_seconds: phases faster than this are too noisy to compare
+    :return: list of (record, baseline seconds) of the regressions
+    """
+
+    previous = dict((_key(record), record['seconds']) for record in baseline)
+    regressions = []
+    for record in records:
+        seconds = previous.get(_key(record))
+        if seconds is not None and record['seconds'] > max(seconds * tolerance, min_seconds):
+            regressions.append((record, seconds))
+    return regressions
+
+
+def _grid(text, cast):
+    return [cast(value) for value in text.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--entities', default='100,1000', help='comma separated numbers of entities')
+    parser.add_argument('--times', default='20', help='comma separated numbers of periods')
+    parser.add_argument('--k', default='3,7', help='comma separated numbers of regressors')
+    parser.add_argument('--missing', default='0,0.3', help='comma separated shares of missing cells')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per phase, the best is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='allowed slowdown ratio against the baseline')
+    parser.add_argument('--min-seconds', type=float, default=1e-3, help='ignore phases faster than this when comparing')
+    args = parser.parse_args(argv)
+
+    records = []
+    for n_entities in _grid(args.entities, int):
+        for n_times in _grid(args.times, int):
+            for k in _grid(args.k, int):
+                for missing in _grid(args.missing, float):
+                    for record in run_case(n_entities, n_times, k, missing, args.repeat, args.seed):
+                        records.append(record)
+                        print('%6d x %4d  k=%-3d missing=%.2f  %-24s %10.4fs %12d bytes' % (
+                            record['entities'], record['times'], record['k'], record['missing'],
+                            record['phase'], record['seconds'], record['peak_bytes']))
+
+    report = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'results': records,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as stored:
+            baseline = json.load(stored)['results']
+        regressions = compare(records, baseline, args.tolerance, args.min_seconds)
+        for record, seconds in regressions:
+            print('REGRESSION %s %s: %.4fs vs baseline %.4fs' % (_key(record)[:4], record['phase'], record['seconds'], seconds))
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
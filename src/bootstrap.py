@@ -0,0 +1,204 @@
+"""
+Bootstrap inference from per-cluster cross-products
+The transformed data is reduced once to the cross-products of [y, X] of every cluster,
+every replicate is then a reweighting of those (pairs-cluster and block-over-time resampling)
+or a sign flip of the cluster scores (wild cluster), so it costs O(G * k^2) instead of a full estimation
+Replicates are drawn in fixed-size chunks with one spawned SeedSequence per chunk, so a seed gives
+the same replicates for any number of worker processes
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from crossprod import CrossProducts, panel_clusters
+from results import PanelResults
+
+METHODS = ('pairs', 'wild', 'block')
+WILD_WEIGHTS = {
+    'rademacher': np.array([-1., 1.]),
+    'webb': np.array([-np.sqrt(1.5), -1., -np.sqrt(.5), np.sqrt(.5), 1., np.sqrt(1.5)]),
+}
+CHUNK_VALUES = 1 << 21  # replicates * clusters * k values held by one chunk
+
+
+class BootstrapResults(PanelResults):
+    __slots__ = ('replicates', 'tstats', 'base_tvalues')
+
+    def __init__(self, params, replicates, tstats, base_tvalues, nobs, df_resid, ssr, tss, depvar, indvars, cov_type):
+        """
+        Initialize the results object
+        :param params: coefficients estimated on the original sample
+        :param replicates: 2D array (replicates * k) of bootstrap coefficients
+        :param tstats: 2D array (replicates * k) of bootstrap t statistics, centered on params
+        :param base_tvalues: cluster-robust t statistics of the original sample, compared against tstats
+        :param nobs: number of observations used
+        :param df_resid: residual degrees of freedom
+        :param ssr: sum of squared residuals
+        :param tss: (uncentered) total sum of squares of the transformed dependent variable
+        :param depvar: name of the dependent variable
+        :param indvars: names of the independent variables
+        :param cov_type: description of the bootstrap
+        :return: nothing
+        """
+
+        cov = np.atleast_2d(np.cov(replicates, rowvar=False))
+        super(BootstrapResults, self).__init__(params, cov, nobs, df_resid, ssr, tss, depvar, indvars, cov_type)
+
+        self.replicates = replicates
+        self.tstats = tstats
+        self.base_tvalues = np.asarray(base_tvalues)
+
+    @property
+    def pvalues(self):
+        # symmetric bootstrap-t
+        return (np.abs(self.tstats) >= np.abs(self.base_tvalues)).mean(axis=0)
+
+    def conf_int(self, alpha=0.05):
+        """
+        Percentile-t confidence intervals
+        :param alpha: significance level
+        :return: 2D array (k * 2) of lower and upper bounds
+        """
+
+        se = self.params / self.base_tvalues
+        lower, upper = np.percentile(self.tstats, [100 * (1 - alpha / 2.), 100 * alpha / 2.], axis=0)
+        return np.column_stack([self.params - lower * se, self.params - upper * se])
+
+
+def _draw(rng, method, size, n_groups, weights, block_length):
+    """
+    Draw the weights of a chunk of replicates
+    :param rng: numpy Generator
+    :param method: 'pairs', 'wild' or 'block'
+    :param size: number of replicates
+    :param n_groups: number of clusters (periods for 'block')
+    :param weights: 'rademacher' or 'webb', for 'wild'
+    :param block_length: number of consecutive periods per block, for 'block'
+    :return: 2D array (size * n_groups), resampling counts or wild multipliers
+    """
+
+    if method == 'wild':
+        return rng.choice(WILD_WEIGHTS[weights], size=(size, n_groups))
+
+    if method == 'pairs':
+        draws = rng.integers(0, n_groups, size=(size, n_groups))
+    else:
+        n_blocks = -(-n_groups // block_length)
+        starts = rng.integers(0, n_groups - block_length + 1, size=(size, n_blocks))
+        draws = (starts[:, :, np.newaxis] + np.arange(block_length)).reshape(size, -1)[:, :n_groups]
+
+    counts = np.zeros((size, n_groups))
+    np.add.at(counts, (np.arange(size)[:, np.newaxis], draws), 1.)
+    return counts
+
+
+def _replicate_task(args):
+    """
+    Worker task: compute one chunk of replicates
+    :param args: tuple of (cluster cross-products (G * (1 + k) * (1 + k)), params, inverse of X'X, method,
+    wild weights, block length, SeedSequence, number of replicates)
+    :return: tuple of (coefficients, t statistics), both 2D arrays (replicates * k)
+    """
+
+    zz, params, xtx_inv, method, weights, block_length, seed, size = args
+
+    rng = np.random.default_rng(seed)
+    xx = zz[:, 1:, 1:]
+    xy = zz[:, 1:, 0]
+    scores = xy - np.einsum('gij,j->gi', xx, params)
+
+    draws = _draw(rng, method, size, zz.shape[0], weights, block_length)
+
+    if method == 'wild':
+        # y* = X b + v_g e_g, so b* - b = (X'X)^-1 sum_g v_g X_g'e_g
+        delta = np.dot(np.dot(draws, scores), xtx_inv)
+        replicates = params + delta
+        replicate_scores = draws[:, :, np.newaxis] * scores - np.einsum('gij,rj->rgi', xx, delta)
+        replicate_inv = np.broadcast_to(xtx_inv, (size,) + xtx_inv.shape)
+        meat = np.einsum('rgi,rgj->rij', replicate_scores, replicate_scores)
+    else:
+        # resampled clusters enter the normal equations as often as they are drawn
+        weighted = np.dot(draws, zz.reshape(zz.shape[0], -1)).reshape((size,) + zz.shape[1:])
+        replicate_inv = np.linalg.pinv(weighted[:, 1:, 1:], hermitian=True)
+        replicates = np.einsum('rij,rj->ri', replicate_inv, weighted[:, 1:, 0])
+        replicate_scores = xy - np.einsum('gij,rj->rgi', xx, replicates)
+        meat = np.einsum('rg,rgi,rgj->rij', draws, replicate_scores, replicate_scores)
+
+    cov = np.einsum('rij,rjk,rkl->ril', replicate_inv, meat, replicate_inv)
+    se = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+    return replicates, (replicates - params) / se
+
+
+def cluster_bootstrap(data, depvar, indvars, method='wild', reps=999, cluster='entity', weights='rademacher',
+                      block_length=None, n_jobs=1, seed=None, panel=None, absorbed=None):
+    """
+    Bootstrap the OLS coefficients of a transformed panel array
+    The transform is not redone per replicate: exact for entity resampling of within and first differenced
+    data, an approximation for time effects partialled out on the original sample
+    :param data: transformed numpy array, (entities * times * (1 + k)) or (rows * (1 + k)) for long panels
+    :param depvar: name of the dependent variable
+    :param indvars: names of the independent variables
+    :param method: 'pairs' (resample clusters), 'wild' (flip the sign of cluster residuals) or
+    'block' (moving blocks of consecutive periods)
+    :param reps: number of replicates
+    :param cluster: 'entity' or 'time', the clusters that are resampled or reweighted ('block' always uses time)
+    :param weights: multipliers of the wild bootstrap, 'rademacher' or 'webb' (six-point, for few clusters)
+    :param block_length: periods per block, by default the cube root of the number of periods
+    :param n_jobs: number of worker processes
+    :param seed: seed of the random draws (int or SeedSequence), the same seed gives the same replicates for any n_jobs
+    :param panel: LongPanel whose rows data is aligned with, None for dense arrays
+    :param absorbed: dict of dimension name -> number of effects removed by the transform, taken off df_resid
+    :return: BootstrapResults
+    """
+
+    assert method in METHODS
+    assert cluster in ('entity', 'time')
+    assert weights in WILD_WEIGHTS
+
+    if method == 'block':
+        cluster = 'time'
+
+    clusters = panel_clusters(data, 'cluster' if cluster == 'entity' else 'cluster_time', panel)[cluster]
+    zz = clusters.zz[clusters.observed]  # clusters with rows, in time order for 'block'
+    n_groups, k = zz.shape[0], zz.shape[1] - 1
+    assert n_groups > 1
+
+    if block_length is None:
+        block_length = max(1, int(round(n_groups ** (1. / 3.))))
+    block_length = min(block_length, n_groups)
+
+    products = CrossProducts(k)
+    products.zz = zz.sum(axis=0)
+    products.nobs = int(clusters.counts.sum())
+    params, xtx_inv = products.solve()
+    ssr = products.yty - np.dot(params, products.xty)
+
+    scores = zz[:, 1:, 0] - np.dot(zz[:, 1:, 1:], params)
+    base_se = np.sqrt(np.diag(np.dot(np.dot(xtx_inv, np.dot(scores.T, scores)), xtx_inv)))
+
+    # chunks depend on the problem size only, not on n_jobs
+    chunk = max(1, min(reps, CHUNK_VALUES // (n_groups * k)))
+    sizes = [min(chunk, reps - start) for start in range(0, reps, chunk)]
+    seeds = (seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)).spawn(len(sizes))
+    tasks = [(zz, params, xtx_inv, method, weights, block_length, chunk_seed, size) for chunk_seed, size in zip(seeds, sizes)]
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(n_jobs) as pool:
+            chunks = list(pool.map(_replicate_task, tasks))
+    else:
+        chunks = [_replicate_task(task) for task in tasks]
+
+    replicates = np.vstack([replicates for replicates, _ in chunks])
+    tstats = np.vstack([tstats for _, tstats in chunks])
+
+    if method == 'wild':
+        cov_type = 'wild bootstrap (%s, %s, %d reps)' % (cluster, weights, reps)
+    elif method == 'pairs':
+        cov_type = 'pairs bootstrap (%s, %d reps)' % (cluster, reps)
+    else:
+        cov_type = 'block bootstrap (time, length %d, %d reps)' % (block_length, reps)
+
+    df_resid = products.nobs - k - (sum(absorbed.values()) if absorbed else 0)
+    return BootstrapResults(params, replicates, tstats, params / base_se, products.nobs, df_resid, ssr,
+                            products.yty, depvar, indvars, cov_type)
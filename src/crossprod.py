@@ -0,0 +1,394 @@
+"""
+Sufficient statistics for OLS on panel data
+Accumulate the cross-product matrix of [y, X] directly from a transformed
+(entities * times * variables) array and solve the small k * k system,
+without ever materializing the long design matrix
+
+A utility for the FE/FD classes
+"""
+
+import numpy as np
+
+from results import PanelResults
+from transforms import entity_demean, first_difference, twoway_demean, valid_mask
+
+BLOCK_ROWS = 1 << 16  # rows processed at a time, bounds the temporary memory to BLOCK_ROWS * k
+COV_TYPES = ('nonrobust', 'robust', 'cluster', 'cluster_time', 'cluster_twoway', 'driscoll_kraay')
+CLUSTER_DIMENSIONS = {
+    'cluster': ('entity',),
+    'cluster_time': ('time',),
+    'cluster_twoway': ('entity', 'time'),
+    'driscoll_kraay': ('time',),
+}
+
+
+def iter_rows(data, block_rows=BLOCK_ROWS):
+    """
+    Iterate over blocks of complete rows of a (..., variables) array
+    :param data: numpy array whose last axis are the variables, depvar first
+    :param block_rows: number of rows per block
+    :return: generator of 2D float64 arrays (valid rows * variables), float32 blocks are upcast one at a time
+    """
+
+    flat = data.reshape(-1, data.shape[-1])
+    for start in range(0, flat.shape[0], block_rows):
+        block = flat[start:start + block_rows].astype(np.float64, copy=False)
+        valid = np.isfinite(block).all(axis=1)
+        yield block if valid.all() else block[valid]
+
+
+class CrossProducts(object):
+    def __init__(self, k):
+        """
+        Initialize an empty accumulator
+        :param k: number of independent variables
+        :return: nothing
+        """
+
+        self.k = k
+        self.zz = np.zeros((k + 1, k + 1))  # [y, X]' [y, X]
+        self.nobs = 0
+
+    @classmethod
+    def from_array(cls, data):
+        """
+        Accumulate the cross-products of a transformed array
+        :param data: numpy array (..., 1 + k), depvar first, NaN rows are skipped
+        :return: CrossProducts
+        """
+
+        products = cls(data.shape[-1] - 1)
+        products.add(data)
+        return products
+
+    def add(self, data, sign=1):
+        """
+        Add (or with sign=-1 remove) the complete rows of an array to the accumulator
+        :param data: numpy array (..., 1 + k), depvar first, NaN rows are skipped
+        :param sign: 1 to add the rows, -1 to remove them
+        :return: nothing
+        """
+
+        assert data.shape[-1] == self.k + 1
+
+        for rows in iter_rows(data):
+            self.zz += sign * np.dot(rows.T, rows)
+            self.nobs += sign * rows.shape[0]
+
+    def remove(self, data):
+        """
+        Remove rows that were added before
+        :param data: numpy array (..., 1 + k), the same values that were added
+        :return: nothing
+        """
+
+        self.add(data, -1)
+
+    def merge(self, other):
+        """
+        Fold another accumulator into this one
+        :param other: CrossProducts
+        :return: nothing
+        """
+
+        assert other.k == self.k
+
+        self.zz += other.zz
+        self.nobs += other.nobs
+
+    @property
+    def xtx(self):
+        return self.zz[1:, 1:]
+
+    @property
+    def xty(self):
+        return self.zz[1:, 0]
+
+    @property
+    def yty(self):
+        return self.zz[0, 0]
+
+    def solve(self):
+        """
+        Solve the normal equations
+        :return: tuple of (coefficients, (X'X)^-1)
+        """
+
+        xtx_inv = np.linalg.pinv(self.xtx)
+        return np.dot(xtx_inv, self.xty), xtx_inv
+
+
+def partial_out(products, k):
+    """
+    Partial the trailing nuisance columns out of accumulated cross-products
+    The Schur complement of the nuisance block gives the cross-products of y and
+    the first k regressors residualized on the nuisance regressors
+    :param products: CrossProducts of [y, X, D]
+    :param k: number of leading regressors to keep
+    :return: CrossProducts of [y, X]
+    """
+
+    keep = k + 1
+    zz = products.zz
+    nuisance_inv = np.linalg.pinv(zz[keep:, keep:])
+
+    partialled = CrossProducts(k)
+    partialled.zz = zz[:keep, :keep] - np.dot(np.dot(zz[:keep, keep:], nuisance_inv), zz[keep:, :keep])
+    partialled.nobs = products.nobs
+    return partialled
+
+
+def robust_meat(data, params):
+    """
+    Second pass over the data for the heteroskedasticity-robust sandwich
+    :param data: numpy array (..., 1 + k), depvar first, NaN rows are skipped
+    :param params: estimated coefficients
+    :return: k * k array, sum of e^2 x x'
+    """
+
+    k = len(params)
+    meat = np.zeros((k, k))
+    for rows in iter_rows(data):
+        scores = rows[:, 1:] * (rows[:, 0] - np.dot(rows[:, 1:], params))[:, np.newaxis]
+        meat += np.dot(scores.T, scores)
+    return meat
+
+
+def transform_block(block, transform='fe', time_totals=None):
+    """
+    Apply a within-entity transform to a block of whole entities
+    :param block: 3D array (entities * times * variables)
+    :param transform: 'fe' for entity demeaning or 'fd' for first differencing
+    :param time_totals: tuple of (time sums, time counts) of the whole panel for the one-shot twoway transform
+    (fe only), see transforms.twoway_demean
+    :return: 3D array of transformed data
+    """
+
+    assert transform in ('fe', 'fd')
+    assert transform == 'fe' or time_totals is None
+
+    if transform == 'fd':
+        return first_difference(block)
+    if time_totals is not None:
+        return twoway_demean(block, None, *time_totals)
+    return entity_demean(block)
+
+
+def block_crossproducts(block, transform='fe', time_effects=False):
+    """
+    Transform one block of whole entities and accumulate its cross-products
+    Within-entity transforms never cross entity boundaries, so blocks can be processed
+    independently and their cross-products merged
+    :param block: 3D array (entities * times * (1 + k)), depvar first
+    :param transform: 'fe' for entity demeaning or 'fd' for first differencing
+    :param time_effects: whether to append the cross-products of entity-demeaned time dummies (all periods but the
+    first) as trailing columns (fe only), to be removed with partial_out after all blocks are merged
+    :return: CrossProducts
+    """
+
+    if not time_effects:
+        return CrossProducts.from_array(transform_block(block, transform))
+
+    assert transform == 'fe'
+
+    mask = valid_mask(block)
+    demeaned = entity_demean(block, mask)
+    k = block.shape[2] - 1
+    n_times = block.shape[1]
+
+    # the dummies are never built: with D~ the entity-demeaned dummies and a_it = mask_it / T_i,
+    # z~' D~ are the time sums of z~ and D~' D~ = diag(time counts) - mask' (mask / T_i)
+    filled = np.where(mask[:, :, np.newaxis], demeaned, 0.)
+    weights = mask / np.maximum(mask.sum(axis=1), 1)[:, np.newaxis]
+    cross = filled.sum(axis=0, dtype=np.float64)[1:]
+    dummies = np.diag(mask.sum(axis=0).astype(np.float64)) - np.dot(mask.T.astype(np.float64), weights)
+
+    products = CrossProducts(k + n_times - 1)
+    products.zz[:k + 1, :k + 1] = CrossProducts.from_array(demeaned).zz
+    products.zz[k + 1:, :k + 1] = cross
+    products.zz[:k + 1, k + 1:] = cross.T
+    products.zz[k + 1:, k + 1:] = dummies[1:, 1:]
+    products.nobs = int(mask.sum())
+    return products
+
+
+class ClusterProducts(object):
+    def __init__(self, k, n_groups):
+        """
+        Per-cluster cross-products of [y, X], gathered with one bincount per block of rows
+        :param k: number of independent variables
+        :param n_groups: number of clusters
+        :return: nothing
+        """
+
+        self.k = k
+        self.n_groups = n_groups
+        self.zz = np.zeros((n_groups, k + 1, k + 1))
+        self.counts = np.zeros(n_groups, dtype=np.int64)  # rows per cluster
+
+    def add(self, rows, codes):
+        """
+        Add complete rows to their clusters
+        :param rows: 2D array (rows * (1 + k)), depvar first, no missing values
+        :param codes: 1D integer array of cluster codes per row
+        :return: nothing
+        """
+
+        width = (self.k + 1) ** 2
+        outer = (rows[:, :, np.newaxis] * rows[:, np.newaxis, :]).reshape(-1, width)
+        index = (codes[:, np.newaxis] * width + np.arange(width)).ravel()
+        self.zz += np.bincount(index, weights=outer.ravel(), minlength=self.n_groups * width).reshape(self.zz.shape)
+        self.counts += np.bincount(codes, minlength=self.n_groups)
+
+    def scores(self, params):
+        """
+        Score sums X_g' e_g of every cluster, from its cross-products alone
+        :param params: estimated coefficients
+        :return: 2D array (clusters * k)
+        """
+
+        return self.zz[:, 1:, 0] - np.dot(self.zz[:, 1:, 1:], params)
+
+    @property
+    def observed(self):
+        return self.counts > 0
+
+    @property
+    def n_observed(self):
+        return int(self.observed.sum())
+
+
+def cluster_products(data, groups, block_rows=BLOCK_ROWS):
+    """
+    Gather per-cluster cross-products of a transformed array in a single blocked pass
+    :param data: numpy array (..., 1 + k), depvar first, NaN rows are skipped
+    :param groups: dict of dimension name -> (1D integer array of codes per row of data, number of clusters)
+    :param block_rows: number of rows per block
+    :return: dict of dimension name -> ClusterProducts
+    """
+
+    k = data.shape[-1] - 1
+    flat = data.reshape(-1, k + 1)
+    products = dict((name, ClusterProducts(k, n_groups)) for name, (_, n_groups) in groups.items())
+
+    for start in range(0, flat.shape[0], block_rows):
+        block = flat[start:start + block_rows].astype(np.float64, copy=False)
+        valid = np.isfinite(block).all(axis=1)
+        rows = block[valid]
+        for name, (codes, _) in groups.items():
+            products[name].add(rows, codes[start:start + block_rows][valid])
+
+    return products
+
+
+def panel_clusters(data, cov_type, panel=None):
+    """
+    Per-cluster cross-products needed by a covariance type
+    :param data: transformed numpy array, (entities * times * (1 + k)) or (rows * (1 + k)) for long panels
+    :param cov_type: covariance type, see ols_results
+    :param panel: LongPanel whose rows data is aligned with, None for dense arrays
+    :return: dict of dimension name -> ClusterProducts, or None if the covariance type is not clustered
+    """
+
+    dimensions = CLUSTER_DIMENSIONS.get(cov_type)
+    if dimensions is None:
+        return None
+
+    if panel is None:
+        n_entities, n_times = data.shape[:2]
+        codes = {
+            'entity': (np.repeat(np.arange(n_entities), n_times), n_entities),
+            'time': (np.tile(np.arange(n_times), n_entities), n_times),
+        }
+    else:
+        codes = {
+            'entity': (panel.entity_codes, len(panel.entities)),
+            'time': (panel.time_codes, len(panel.times)),
+        }
+
+    return cluster_products(data, dict((dimension, codes[dimension]) for dimension in dimensions))
+
+
+def hac_meat(scores, maxlags):
+    """
+    Newey-West (Bartlett kernel) meat over time-ordered score sums, the Driscoll-Kraay estimator
+    :param scores: 2D array (periods * k) of per-period score sums, in time order
+    :param maxlags: number of lags
+    :return: k * k array
+    """
+
+    meat = np.dot(scores.T, scores)
+    for lag in range(1, maxlags + 1):
+        weight = 1. - lag / (maxlags + 1.)
+        gamma = np.dot(scores[lag:].T, scores[:-lag])
+        meat += weight * (gamma + gamma.T)
+    return meat
+
+
+def ols_results(products, depvar, indvars, cov_type='nonrobust', data=None, meat=None, clusters=None, absorbed=None, maxlags=None):
+    """
+    Estimate OLS from accumulated cross-products
+    :param products: CrossProducts
+    :param depvar: name of the dependent variable
+    :param indvars: names of the independent variables
+    :param cov_type: 'nonrobust' (classic), 'robust' (HC1), 'cluster' (by entity), 'cluster_time',
+    'cluster_twoway' (entity and time) or 'driscoll_kraay' (HAC over per-period score sums)
+    :param data: the transformed array the products came from, required for robust and two-way clustered standard errors
+    :param meat: precomputed robust meat (e.g. from a second pass over streamed chunks), instead of data
+    :param clusters: dict of dimension name ('entity', 'time') -> ClusterProducts, required for the clustered types
+    :param absorbed: dict of dimension name -> number of effects absorbed by the transform, e.g. {'entity': n_entities}
+    for the within transform; they are taken off the residual degrees of freedom, and count in the small sample
+    correction of the clustered types except when nested in the clusters
+    :param maxlags: number of lags of the Driscoll-Kraay estimator, 4 * (T / 100) ^ (2 / 9) with T observed periods
+    if not supplied
+    :return: PanelResults
+    """
+
+    assert cov_type in COV_TYPES
+
+    if absorbed is None:
+        absorbed = {}
+
+    params, xtx_inv = products.solve()
+
+    nobs = products.nobs
+    k = products.k
+    df_resid = nobs - k - sum(absorbed.values())
+    ssr = products.yty - np.dot(params, products.xty)
+
+    if cov_type == 'nonrobust':
+        cov = xtx_inv * ssr / df_resid
+    elif cov_type == 'robust':
+        if meat is None:
+            assert data is not None
+            meat = robust_meat(data, params)
+        cov = np.dot(np.dot(xtx_inv, meat), xtx_inv) * nobs / df_resid
+    else:
+        dimensions = CLUSTER_DIMENSIONS[cov_type]
+        assert clusters is not None and all(dimension in clusters for dimension in dimensions)
+
+        # effects nested in the clusters do not count against the degrees of freedom
+        k_effective = k + sum(count for dimension, count in absorbed.items() if dimension not in dimensions)
+
+        if cov_type == 'driscoll_kraay':
+            scores = clusters['time'].scores(params)
+            if maxlags is None:
+                maxlags = int(np.floor(4 * (clusters['time'].n_observed / 100.) ** (2. / 9.)))
+            meat = hac_meat(scores, maxlags)
+            scale = float(nobs - 1) / (nobs - k_effective)
+        else:
+            meat = np.zeros((k, k))
+            for dimension in dimensions:
+                scores = clusters[dimension].scores(params)
+                meat += np.dot(scores.T, scores)
+            if cov_type == 'cluster_twoway':
+                # entity-time intersections are single cells, their meat is the heteroskedastic one
+                assert data is not None
+                meat -= robust_meat(data, params)
+
+            n_groups = min(clusters[dimension].n_observed for dimension in dimensions)
+            scale = n_groups / (n_groups - 1.) * (nobs - 1.) / (nobs - k_effective)
+
+        cov = np.dot(np.dot(xtx_inv, meat), xtx_inv) * scale
+
+    return PanelResults(params, cov, nobs, df_resid, ssr, products.yty, depvar, indvars, cov_type)
@@ -3,33 +3,62 @@ First Differences for Panel data
 """
 
 import numpy as np
-import pandas as pd
-import statsmodels.api as sm
+
+from bootstrap import cluster_bootstrap
+from crossprod import CrossProducts, ols_results, panel_clusters
+from instrument import NO_INSTRUMENTATION, get_instrumentation
+from panel_data import LongPanel, PanelData
+from panel_store import PanelStore
+from parallel import parallel_crossproducts
+from streaming import stream_estimate
+from transform_cache import TRANSFORM_CACHE, fingerprint
+from transforms import first_difference, long_first_difference
 
 
 class FirstDiff(object):
-    def __init__(self, panel, y, x):
+    def __init__(self, panel, y, x, cache=None, instrument=None, dtype=np.float64, lag=1, order=1):
         """
         Initialize the first difference class
-        :param panel: Pandas Panel where items are entities, major axis is time and minor axis are variables
+        :param panel: PanelData (entities * times * variables), LongPanel (observed rows only) or PanelStore
+        (only the variables of the model are read from disk)
         :param y: name of the dependent variable
         :param x: name of the independent variables
+        :param cache: True to reuse differenced variables from the shared TRANSFORM_CACHE, or a TransformCache
+        (dense panels only)
+        :param instrument: True or an Instrumentation to record time, memory and copies per phase, off by default
+        :param dtype: working dtype of the data and its transforms, np.float32 halves their memory
+        (sums and cross-products are still accumulated in float64)
+        :param lag: number of periods to difference over, e.g. 4 for seasonal differences of quarterly data
+        :param order: number of times to difference
         :return: nothing
         """
 
-        assert type(panel) is pd.Panel
+        assert type(panel) in (PanelData, LongPanel, PanelStore)
+        assert lag >= 1 and order >= 1
+        assert np.dtype(dtype) in (np.dtype(np.float64), np.dtype(np.float32))
+
+        if type(x) is str:
+            x = [x]
+
+        if cache is True:
+            cache = TRANSFORM_CACHE
+
+        # cache keys come from the panel as passed, so the panels loaded from one store share entries
+        variable_keys = fingerprint(panel, [y] + list(x)) if cache is not None and type(panel) is not LongPanel else None
+
+        if type(panel) is PanelStore:
+            # page in only the variables the model uses
+            panel = panel.load([y] + list(x))
 
         self.panel = panel
+        self.long = type(panel) is LongPanel
 
-        self.variables = panel.axes[2].tolist()  # get minor axis
-        self.times = panel.axes[1].tolist()  # get major axis
-        self.entities = panel.axes[0].tolist()  # get entities
+        self.variables = panel.variables.tolist()
+        self.times = panel.times.tolist()
+        self.entities = panel.entities.tolist()
 
         assert y in self.variables
 
-        if type(x) is str:
-            x = [x]
-
         for indvar in x:
             assert indvar in self.variables
             assert indvar != y
@@ -37,40 +66,157 @@ class FirstDiff(object):
         self.depvar = y
         self.indvars = x
 
-        self.y_panel = self.panel.loc[:, :, self.depvar].astype(np.float)
-        self.x_panel = self.panel.loc[:, :, self.indvars].astype(np.float)
+        self.instrument = get_instrumentation(instrument)
+
+        # one contiguous (entities * times * variables) or (rows * variables) array, depvar first
+        with self.instrument.phase('select'):
+            self.data = self.instrument.copied(self.panel.select([self.depvar] + self.indvars).astype(dtype, copy=False))
+
+        self.lag = lag
+        self.order = order
+
+        self.differenced = None
+        self.fd_y = None
+        self.fd_x = None
 
         self.result = None
 
+        self.cache = cache if not self.long else None
+        self.variable_keys = variable_keys
+
     def __first_diff(self):
         """
-        First difference the supplied data
+        Difference all variables at once, gap-aware: a missing period gives NaN instead of a difference across it
         :return: nothing
         """
 
-        self.fd_y = self.y_panel.diff(1)
-        self.fd_x = self.x_panel.copy()
-        for indvar in self.indvars:
-            slice = self.x_panel.loc[:,:,indvar].diff(1)
-            self.fd_x.loc[:,:,indvar] = slice
-
-    def estimate(self):
+        if self.long:
+            # differences only between periods of the same entity exactly lag apart
+            self.differenced = long_first_difference(self.data, self.panel.entity_codes, self.panel.time_codes,
+                                                     self.lag, self.order)
+        elif self.cache is not None:
+            # reuse variables differenced on the same panel
+            self.differenced = self.cache.transform(self.variable_keys, self.data, 'fd', self.lag, self.order)
+        else:
+            # entities * (times - lag * order) * variables, written into the buffer of a previous call if there is one
+            self.differenced = first_difference(self.data, self.lag, self.order, out=self.differenced)
+        self.instrument.copied(self.differenced)
+        self.fd_y = self.differenced[..., 0]
+        self.fd_x = self.differenced[..., 1:]
+
+    def estimate(self, backend='crossprod', cov_type='nonrobust', n_jobs=1, maxlags=None, verbose=False):
         """
         Estimate the first differenced OLS
+        :param backend: 'crossprod' to solve from X'X and X'y, 'statsmodels' to fit on the long design matrix
+        (imports statsmodels, returns its results object)
+        :param cov_type: covariance type of the 'crossprod' backend, 'nonrobust', 'robust' (HC1), 'cluster' (by entity),
+        'cluster_time', 'cluster_twoway' or 'driscoll_kraay', see crossprod.ols_results
+        :param n_jobs: number of worker processes, more than one splits entities across a process pool
+        (uses the 'crossprod' backend, nonrobust or robust only)
+        :param maxlags: number of lags of the Driscoll-Kraay covariance
+        :param verbose: whether to print the summary
         :return: results
         """
-        # first difference data
-        self.__first_diff()
 
-        # first, make a dataframe out of the panel of indvars
-        x_dataframe = self.fd_x.transpose(2,0,1).to_frame(False) # set to False to not drop NaNs
-        # unstack the depvar dataframe into a series
-        y_series = self.fd_y.unstack()
+        assert backend in ('statsmodels', 'crossprod')
+
+        instrument = self.instrument
+        first_record = len(instrument.records)  # phases of this call only
+        summary_names = ()
+
+        if n_jobs > 1:
+            assert not self.long
+            assert cov_type in ('nonrobust', 'robust')
+            assert self.lag == 1 and self.order == 1
+            # levels go to the workers, each one differences its own entities
+            with instrument.phase('parallel'):
+                products, meat = parallel_crossproducts(self.data, 'fd', False, n_jobs, cov_type)
+            with instrument.phase('solve'):
+                results = ols_results(products, self.depvar, self.indvars, cov_type, meat=meat)
+
+        else:
+            # first difference data
+            with instrument.phase('difference'):
+                self.__first_diff()
+
+            if backend == 'crossprod':
+                with instrument.phase('design'):
+                    products = CrossProducts.from_array(self.differenced)
+                    clusters = panel_clusters(self.differenced, cov_type, self.panel if self.long else None)
+                with instrument.phase('solve'):
+                    results = ols_results(products, self.depvar, self.indvars, cov_type, self.differenced,
+                                          clusters=clusters, maxlags=maxlags)
+
+            else:
+                # flatten into long (entity, time) rows, NaN rows are dropped by statsmodels
+                with instrument.phase('design'):
+                    x_values = self.fd_x.reshape(-1, len(self.indvars)).astype(np.float64, copy=False)
+                    y_values = self.fd_y.reshape(-1).astype(np.float64, copy=False)
+
+                # fit regression model with statsmodels
+                with instrument.phase('solve'):
+                    import statsmodels.api as sm
+                    results = sm.OLS(y_values, x_values, missing='drop').fit()
+                summary_names = (self.depvar, self.indvars)
+
+        if instrument is not NO_INSTRUMENTATION:
+            results.phases = instrument.records[first_record:]
+
+        if verbose:
+            print(results.summary(*summary_names))
 
-        # fit regression model with statsmodels
-        results = sm.OLS(y_series.values, x_dataframe.values, missing='drop').fit()
+        self.result = results
+        return results
+
+    def bootstrap(self, method='wild', reps=999, cluster='entity', weights='rademacher', block_length=None, n_jobs=1,
+                  seed=None, verbose=False):
+        """
+        Bootstrap inference for the first differenced model, see bootstrap.cluster_bootstrap
+        The differencing is done once and reused by later calls, replicates only reweight per-cluster cross-products
+        :param method: 'pairs' (resample clusters), 'wild' (wild cluster) or 'block' (moving blocks of periods)
+        :param reps: number of replicates
+        :param cluster: 'entity' or 'time'
+        :param weights: multipliers of the wild bootstrap, 'rademacher' or 'webb'
+        :param block_length: periods per block of the block bootstrap
+        :param n_jobs: number of worker processes
+        :param seed: seed of the random draws, results do not depend on n_jobs
+        :param verbose: whether to print the summary
+        :return: results
+        """
+
+        first_record = len(self.instrument.records)  # phases of this call only
+
+        if self.differenced is None:
+            with self.instrument.phase('difference'):
+                self.__first_diff()
+
+        with self.instrument.phase('bootstrap'):
+            results = cluster_bootstrap(self.differenced, self.depvar, self.indvars, method, reps, cluster, weights, block_length,
+                                        n_jobs, seed, self.panel if self.long else None)
 
-        print(results.summary(self.depvar, self.indvars))
+        if self.instrument is not NO_INSTRUMENTATION:
+            results.phases = self.instrument.records[first_record:]
+
+        if verbose:
+            print(results.summary())
 
         self.result = results
+        return results
+
+    @staticmethod
+    def estimate_chunks(source, y, x, cov_type='nonrobust', verbose=False, **reader_options):
+        """
+        Estimate the first differenced model out of core, reading the panel one block of entities at a time
+        :param source: path(s) to .npy shards or long-format .csv/.parquet files, or in-memory chunks
+        :param y: name of the dependent variable
+        :param x: name of the independent variables
+        :param cov_type: 'nonrobust' or 'robust' (HC1), robust reads the source twice
+        :param verbose: whether to print the summary
+        :param reader_options: keyword arguments of streaming.read_chunks (entity_col, time_col, times, chunksize, columns)
+        :return: results
+        """
 
+        results = stream_estimate(source, y, x, 'fd', cov_type=cov_type, **reader_options)
+        if verbose:
+            print(results.summary())
+        return results
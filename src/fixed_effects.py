@@ -4,33 +4,75 @@ Fixed Effects for Panel Data
 
 import numpy as np
 import pandas as pd
-import statsmodels.api as sm
+
+from bootstrap import cluster_bootstrap
+from crossprod import CrossProducts, ols_results, panel_clusters
+from instrument import NO_INSTRUMENTATION, get_instrumentation
+from panel_data import LongPanel, PanelData
+from panel_store import PanelStore
+from parallel import parallel_crossproducts
+from streaming import stream_estimate
+from transform_cache import TRANSFORM_CACHE, fingerprint
+from transforms import GroupIndex, absorb, absorbed_counts, entity_demean, twoway_demean
 
 
 class FixedEffects(object):
-    def __init__(self, panel, y, x, time=False):
+    def __init__(self, panel, y, x, time=False, absorb=None, iterative=False, tol=1e-8, maxiter=1000, accelerate=True,
+                 cache=None, instrument=None, dtype=np.float64):
         """
         Initialize the Fixed Effects class
-        :param panel: Pandas Panel where items are entities, major axis is time and minor axis are variables
+        :param panel: PanelData (entities * times * variables), LongPanel (observed rows only) or PanelStore
+        (only the variables of the model are read from disk)
         :param y: name of the dependent variable
         :param x: name of the independent variables
-        :param time: whether to include time effects too
+        :param time: whether to include time effects too, with the one-shot twoway transform (exact for balanced
+        panels only) unless iterative
+        :param absorb: list of additional effects to absorb, each either a variable name in the panel or an array-like
+        of group labels shaped like one variable of the panel, e.g. industry*year codes
+        :param iterative: whether to absorb entity (and time) effects by alternating projections, implied by absorb
+        and by long-format panels
+        :param tol: convergence tolerance of the alternating projections
+        :param maxiter: maximum number of alternating projection sweeps
+        :param accelerate: whether to use Irons-Tuck acceleration in the alternating projections
+        :param cache: True to reuse demeaned variables from the shared TRANSFORM_CACHE, or a TransformCache
+        (dense panels and one-shot demeaning only)
+        :param instrument: True or an Instrumentation to record time, memory and copies per phase, off by default
+        :param dtype: working dtype of the data and its transforms, np.float32 halves their memory
+        (sums and cross-products are still accumulated in float64)
         :return: nothing
         """
 
-        assert type(panel) is pd.Panel
+        assert type(panel) in (PanelData, LongPanel, PanelStore)
+        assert np.dtype(dtype) in (np.dtype(np.float64), np.dtype(np.float32))
+
+        if type(x) is str:
+            x = [x]
+
+        if absorb is None:
+            absorb = []
+        elif type(absorb) is str:
+            absorb = [absorb]
+
+        if cache is True:
+            cache = TRANSFORM_CACHE
+
+        # cache keys come from the panel as passed, so the panels loaded from one store share entries
+        cached = cache is not None and not (iterative or absorb or type(panel) is LongPanel)
+        variable_keys = fingerprint(panel, [y] + list(x)) if cached else None
+
+        if type(panel) is PanelStore:
+            # page in only the variables the model uses
+            panel = panel.load([y] + list(x) + [effect for effect in absorb if type(effect) is str])
 
         self.panel = panel
+        self.long = type(panel) is LongPanel
 
-        self.variables = panel.axes[2].tolist()  # get minor axis
-        self.times = panel.axes[1].tolist()  # get major axis
-        self.entities = panel.axes[0].tolist()  # get entities
+        self.variables = panel.variables.tolist()
+        self.times = panel.times.tolist()
+        self.entities = panel.entities.tolist()
 
         assert y in self.variables
 
-        if type(x) is str:
-            x = [x]
-
         for indvar in x:
             assert indvar in self.variables
             assert indvar != y
@@ -38,16 +80,36 @@ class FixedEffects(object):
         self.depvar = y
         self.indvars = x
 
-        self.y_panel = self.panel.loc[:, :, self.depvar].astype(np.float)
-        self.x_panel = self.panel.loc[:, :, self.indvars].astype(np.float)
+        self.instrument = get_instrumentation(instrument)
+
+        # one contiguous (entities * times * variables) or (rows * variables) array, depvar first
+        with self.instrument.phase('select'):
+            self.data = self.instrument.copied(self.panel.select([self.depvar] + self.indvars).astype(dtype, copy=False))
 
-        self.y_demeaned = self.y_panel.copy()
-        self.x_demeaned = self.x_panel.copy()
+        self.demeaned = None
+        self.y_demeaned = None
+        self.x_demeaned = None
 
         self.result = None
 
         self.time = time
 
+        for effect in absorb:
+            if type(effect) is str:
+                assert effect in self.variables
+
+        self.absorb = absorb
+        self.iterative = iterative or len(absorb) > 0 or self.long
+        self.tol = tol
+        self.maxiter = maxiter
+        self.accelerate = accelerate
+        self.iterations = 0
+        self.n_absorbed = 0  # independent additional effects absorbed, net of the ones nested in other dimensions
+        self.effect_counts = None  # independent effects per absorbed dimension of the iterative path
+
+        self.cache = cache if not self.iterative else None
+        self.variable_keys = variable_keys
+
     def __demean(self):
         """
         Demean all variables
@@ -56,47 +118,220 @@ class FixedEffects(object):
         :return: nothing
         """
 
-        if self.time:
+        if self.iterative:
+            # any number of effects, exact for unbalanced panels
+            demeaned = self.__absorb()
+        elif self.cache is not None:
+            # reuse variables demeaned on the same panel and sample
+            demeaned = self.cache.transform(self.variable_keys, self.data, 'twoway' if self.time else 'entity')
+        elif self.time:
             # twoway demeaning
-            y_entity_mean = self.y_panel.mean(axis=0)
-            y_time_mean = self.y_panel.mean(axis=1)
-            y_grand_mean = self.y_panel.mean().mean() # double mean
-            self.y_demeaned = self.y_demeaned - y_entity_mean + y_grand_mean # still need to remove time mean
-            self.y_demeaned = self.y_demeaned.sub(y_time_mean, axis=0)
-
-            for indvar in self.indvars:
-                slice = self.x_panel.loc[:, :, indvar]
-                slice_ent_mean = slice.mean(axis=0)
-                slice_time_mean = slice.mean(axis=1)
-                slice_g_mean = slice_ent_mean.mean()
-                self.x_demeaned.loc[:, :, indvar] = self.x_demeaned.loc[:, :, indvar] - slice_ent_mean + slice_g_mean
-                self.x_demeaned.loc[:, :, indvar] = self.x_demeaned.loc[:, :, indvar].sub(slice_time_mean, axis=0)
+            demeaned = twoway_demean(self.data)
         else:
             # only entity fixed effects
-            y_mean = self.y_panel.mean() # ths will give means by entity
-            self.y_demeaned = self.y_demeaned - y_mean  # demean y
+            demeaned = entity_demean(self.data)
+
+        self.demeaned = self.instrument.copied(demeaned)
+        self.y_demeaned = demeaned[..., 0]
+        self.x_demeaned = demeaned[..., 1:]
+
+    def __absorb(self):
+        """
+        Absorb entity, time (if self.time) and all additional effects by alternating projections
+        Group means are grouped reductions on integer entity and time codes, for dense and long panels alike
+        :return: array of demeaned data shaped like self.data, NaN in invalid cells
+        """
+
+        k = self.data.shape[-1]
+        flat = self.data.reshape(-1, k)
+        valid = np.isfinite(flat).all(axis=1)
+
+        n_entities = len(self.entities)
+        n_times = len(self.times)
+
+        # factorize the labels of additional effects, cells with a missing label are dropped
+        labels = []
+        for effect in self.absorb:
+            if type(effect) is str:
+                effect = self.panel.var(effect)
+            effect = np.asarray(effect)
+            assert effect.shape == self.data.shape[:-1]
+            codes, _ = pd.factorize(effect.ravel())
+            labels.append(codes)
+            valid &= codes >= 0
+
+        rows = np.flatnonzero(valid)
+
+        if self.long:
+            entity_codes = self.panel.entity_codes[rows]
+            time_codes = self.panel.time_codes[rows]
+        else:
+            entity_codes = rows // n_times
+            time_codes = rows % n_times
+
+        groups = [GroupIndex(entity_codes, n_entities)]
+        if self.time:
+            groups.append(GroupIndex(time_codes, n_times))
+        for codes in labels:
+            codes, uniques = pd.factorize(codes[rows])
+            groups.append(GroupIndex(codes, len(uniques)))
+        # independent effects per dimension, net of nesting (e.g. years within industry * year)
+        self.effect_counts = absorbed_counts(groups)
+        self.n_absorbed = sum(self.effect_counts[2 if self.time else 1:])
+
+        absorbed, self.iterations = absorb(flat[rows], groups, self.tol, self.maxiter, self.accelerate)
+
+        demeaned = np.full(flat.shape, np.nan, dtype=self.data.dtype)
+        demeaned[rows] = absorbed
+        return demeaned.reshape(self.data.shape)
+
+    def __absorbed(self):
+        """
+        Count the effects absorbed by the demeaning, taken off the residual degrees of freedom
+        :return: dict of dimension name -> number of effects
+        """
+
+        if self.effect_counts is not None:
+            # counted over the rows that were absorbed, net of nested dimensions
+            absorbed = {'entity': self.effect_counts[0], 'other': self.n_absorbed}
+            if self.time:
+                absorbed['time'] = self.effect_counts[1]
+            return absorbed
+
+        # the demeaned rows when there are some
+        valid = np.isfinite(self.demeaned if self.demeaned is not None else self.data).all(axis=-1)
+        if self.long:
+            entities = np.unique(self.panel.entity_codes[valid]).shape[0]
+            times = np.unique(self.panel.time_codes[valid]).shape[0]
+        else:
+            entities = int(valid.any(axis=1).sum())
+            times = int(valid.any(axis=0).sum())
 
-            for indvar in self.indvars:
-                slice = self.x_panel.loc[:, :, indvar]
-                slice_mean = slice.mean()
-                self.x_demeaned.loc[:, :, indvar] = self.x_demeaned.loc[:, :, indvar] - slice_mean
+        absorbed = {'entity': entities, 'other': self.n_absorbed}
+        if self.time:
+            absorbed['time'] = times - 1
+        return absorbed
 
-    def estimate(self):
+    def estimate(self, backend='crossprod', cov_type='nonrobust', n_jobs=1, maxlags=None, verbose=False):
         """
         Estimate the FE model with OLS
+        :param backend: 'crossprod' to solve from X'X and X'y, 'statsmodels' to fit on the long design matrix
+        (imports statsmodels, returns its results object)
+        :param cov_type: covariance type of the 'crossprod' backend, 'nonrobust', 'robust' (HC1), 'cluster' (by entity),
+        'cluster_time', 'cluster_twoway' or 'driscoll_kraay', see crossprod.ols_results
+        :param n_jobs: number of worker processes, more than one splits entities across a process pool
+        (uses the 'crossprod' backend and the same transforms as one process, nonrobust or robust only, and nonrobust
+        only with iterative time effects)
+        :param maxlags: number of lags of the Driscoll-Kraay covariance
+        :param verbose: whether to print the summary
         :return: results
         """
-        # demean
-        self.__demean()
 
-        # first, make a dataframe out of the panel of indvars
-        x_dataframe = self.x_demeaned.transpose(2,0,1).to_frame(False) # set to False to not drop NaNs
-        # unstack the depvar dataframe into a series
-        y_series = self.y_demeaned.unstack()
+        assert backend in ('statsmodels', 'crossprod')
+
+        instrument = self.instrument
+        first_record = len(instrument.records)  # phases of this call only
+        summary_names = ()
+
+        if n_jobs > 1:
+            assert not self.absorb and not self.long
+            assert cov_type in ('nonrobust', 'robust')
+            assert cov_type == 'nonrobust' or not (self.time and self.iterative), 'exact time effects in parallel are nonrobust only'
+            with instrument.phase('parallel'):
+                products, meat = parallel_crossproducts(self.data, 'fe', self.time, n_jobs, cov_type, self.iterative)
+            with instrument.phase('solve'):
+                results = ols_results(products, self.depvar, self.indvars, cov_type, meat=meat, absorbed=self.__absorbed())
 
-        # fit regression model with statsmodels
-        results = sm.OLS(y_series.values, x_dataframe.values, missing='drop').fit()
+        else:
+            # demean
+            with instrument.phase('demean'):
+                self.__demean()
+
+            if backend == 'crossprod':
+                # accumulate sufficient statistics straight from the demeaned array
+                with instrument.phase('design'):
+                    products = CrossProducts.from_array(self.demeaned)
+                    clusters = panel_clusters(self.demeaned, cov_type, self.panel if self.long else None)
+                with instrument.phase('solve'):
+                    results = ols_results(products, self.depvar, self.indvars, cov_type, self.demeaned,
+                                          clusters=clusters, absorbed=self.__absorbed(), maxlags=maxlags)
+
+            else:
+                # flatten into long (entity, time) rows, NaN rows are dropped by statsmodels
+                with instrument.phase('design'):
+                    x_values = self.x_demeaned.reshape(-1, len(self.indvars)).astype(np.float64, copy=False)
+                    y_values = self.y_demeaned.reshape(-1).astype(np.float64, copy=False)
+
+                # fit regression model with statsmodels
+                with instrument.phase('solve'):
+                    import statsmodels.api as sm
+                    model = sm.OLS(y_values, x_values, missing='drop')
+                    model.df_resid = model.nobs - model.exog.shape[1] - sum(self.__absorbed().values())
+                    results = model.fit()
+                summary_names = (self.depvar, self.indvars)
 
-        print(results.summary(self.depvar, self.indvars))
+        if instrument is not NO_INSTRUMENTATION:
+            results.phases = instrument.records[first_record:]
+
+        if verbose:
+            print(results.summary(*summary_names))
 
         self.result = results
+        return results
+
+    def bootstrap(self, method='wild', reps=999, cluster='entity', weights='rademacher', block_length=None, n_jobs=1,
+                  seed=None, verbose=False):
+        """
+        Bootstrap inference for the FE model, see bootstrap.cluster_bootstrap
+        The demeaning is done once and reused by later calls, replicates only reweight per-cluster cross-products
+        :param method: 'pairs' (resample clusters), 'wild' (wild cluster) or 'block' (moving blocks of periods)
+        :param reps: number of replicates
+        :param cluster: 'entity' or 'time'
+        :param weights: multipliers of the wild bootstrap, 'rademacher' or 'webb'
+        :param block_length: periods per block of the block bootstrap
+        :param n_jobs: number of worker processes
+        :param seed: seed of the random draws, results do not depend on n_jobs
+        :param verbose: whether to print the summary
+        :return: results
+        """
+
+        first_record = len(self.instrument.records)  # phases of this call only
+
+        if self.demeaned is None:
+            with self.instrument.phase('demean'):
+                self.__demean()
+
+        with self.instrument.phase('bootstrap'):
+            results = cluster_bootstrap(self.demeaned, self.depvar, self.indvars, method, reps, cluster, weights, block_length,
+                                        n_jobs, seed, self.panel if self.long else None, self.__absorbed())
+
+        if self.instrument is not NO_INSTRUMENTATION:
+            results.phases = self.instrument.records[first_record:]
+
+        if verbose:
+            print(results.summary())
+
+        self.result = results
+        return results
+
+    @staticmethod
+    def estimate_chunks(source, y, x, time=False, cov_type='nonrobust', iterative=False, verbose=False, **reader_options):
+        """
+        Estimate the FE model out of core, reading the panel one block of entities at a time
+        The estimates are those of FixedEffects(panel, y, x, time, iterative=iterative).estimate(cov_type=cov_type)
+        :param source: path(s) to .npy shards or long-format .csv/.parquet files, or in-memory chunks
+        :param y: name of the dependent variable
+        :param x: name of the independent variables
+        :param time: whether to include time effects too, by default with the one-shot twoway transform
+        (exact for balanced panels only), whose time sums take one more pass over the source
+        :param cov_type: 'nonrobust' or 'robust' (HC1), robust reads the source twice
+        :param iterative: whether to partial out exact time effects instead (as time dummies, nonrobust only)
+        :param verbose: whether to print the summary
+        :param reader_options: keyword arguments of streaming.read_chunks (entity_col, time_col, times, chunksize, columns)
+        :return: results
+        """
+
+        results = stream_estimate(source, y, x, 'fe', time, cov_type, iterative, **reader_options)
+        if verbose:
+            print(results.summary())
+        return results
@@ -0,0 +1,351 @@
+"""
+Incremental estimation for panels that grow one period at a time
+New time slices (entities * variables, as passed to PanelBuilder.frames_by_time)
+update running accumulators, the coefficients are re-solved without touching
+historical data
+Rolling and expanding windows use the same accumulators, removing the outgoing period
+"""
+
+import numpy as np
+import pandas as pd
+
+from crossprod import CrossProducts, ols_results
+from panel_data import PanelData
+from panel_store import PanelStore
+
+
+class WithinMoments(object):
+    def __init__(self, k):
+        """
+        Running moments for the within (entity-demeaned) cross-products
+        Keeps the raw cross-products of [y, X] plus per-entity sums and counts, since
+        sum_it z~ z~' = sum_it z z' - sum_i s_i s_i' / n_i
+        :param k: number of independent variables
+        :return: nothing
+        """
+
+        self.k = k
+        self.raw = np.zeros((k + 1, k + 1))
+        self.sums = np.zeros((0, k + 1))
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.shift = None  # subtracted from every row to avoid cancellation in the raw moments
+
+    def grow(self, n_entities):
+        """
+        Make room for new entities
+        :param n_entities: total number of entities
+        :return: nothing
+        """
+
+        extra = n_entities - self.sums.shape[0]
+        if extra > 0:
+            self.sums = np.vstack([self.sums, np.zeros((extra, self.k + 1))])
+            self.counts = np.concatenate([self.counts, np.zeros(extra, dtype=np.int64)])
+
+    def add(self, values, sign=1):
+        """
+        Add (or with sign=-1 remove) one time slice
+        :param values: 2D array (entities * (1 + k)), depvar first, rows with NaN are skipped
+        :param sign: 1 to add the slice, -1 to remove it
+        :return: nothing
+        """
+
+        self.grow(values.shape[0])
+
+        valid = np.isfinite(values).all(axis=1)
+        rows = values[valid]
+        if self.shift is None:
+            if rows.shape[0] == 0:
+                return
+            self.shift = rows.mean(axis=0)
+        rows = rows - self.shift
+
+        self.raw += sign * np.dot(rows.T, rows)
+        self.sums[np.flatnonzero(valid)] += sign * rows
+        self.counts[valid] += sign
+
+    def remove(self, values):
+        """
+        Remove a time slice that was added before
+        :param values: 2D array (entities * (1 + k)), the same values that were added
+        :return: nothing
+        """
+
+        self.add(values, -1)
+
+    @property
+    def nobs(self):
+        return int(self.counts.sum())
+
+    @property
+    def n_observed(self):
+        return int((self.counts > 0).sum())
+
+    def crossproducts(self):
+        """
+        Within cross-products of everything added so far
+        :return: CrossProducts
+        """
+
+        observed = self.counts > 0
+        sums = self.sums[observed]
+
+        products = CrossProducts(self.k)
+        products.zz = self.raw - np.dot(sums.T, sums / self.counts[observed][:, np.newaxis])
+        products.nobs = self.nobs
+        return products
+
+
+class IncrementalEstimator(object):
+    def __init__(self, y, x, entities=None, variables=None):
+        """
+        Common slice handling of the incremental estimators
+        :param y: name of the dependent variable
+        :param x: name of the independent variables
+        :param entities: array-like of entity labels known upfront, new labels in later slices are appended
+        :param variables: names of the columns of array slices, e.g. all the variables of the panel as passed to
+        PanelBuilder.frames_by_time, [y] + x if not supplied
+        :return: nothing
+        """
+
+        if type(x) is str:
+            x = [x]
+
+        for indvar in x:
+            assert indvar != y
+
+        self.depvar = y
+        self.indvars = list(x)
+
+        if variables is None:
+            variables = [y] + self.indvars
+        self.columns = [list(variables).index(variable) for variable in [y] + self.indvars]
+        self.n_columns = len(variables)
+
+        self.entities = []
+        self.positions = {}
+        if entities is not None:
+            self.__add_entities(list(entities))
+
+        self.times = []
+        self.result = None
+
+    def __add_entities(self, labels):
+        for label in labels:
+            if label not in self.positions:
+                self.positions[label] = len(self.entities)
+                self.entities.append(label)
+
+    def _align(self, frame):
+        """
+        Put one time slice into the entity order of the estimator
+        :param frame: pandas DataFrame (entities * variables) indexed by entity with variable columns,
+        or 2D array-like with rows in the order of self.entities and the columns named by variables
+        :return: 2D array (entities * (1 + k))
+        """
+
+        variables = [self.depvar] + self.indvars
+
+        if type(frame) is pd.DataFrame:
+            labels = frame.index.tolist()
+            self.__add_entities(labels)
+            values = np.full((len(self.entities), len(variables)), np.nan)
+            values[[self.positions[label] for label in labels]] = frame[variables].values.astype(np.float64)
+            return values
+
+        values = np.asarray(frame, dtype=np.float64)
+        if not self.entities:
+            self.__add_entities(range(values.shape[0]))
+        assert values.shape == (len(self.entities), self.n_columns), 'slices must have one row per entity and one column per variable'
+        return values[:, self.columns]
+
+    @classmethod
+    def from_panel(cls, panel, y, x):
+        """
+        Initialize the estimator with the history of a panel
+        :param panel: PanelData or PanelStore
+        :param y: name of the dependent variable
+        :param x: name of the independent variables
+        :return: estimator
+        """
+
+        assert type(panel) in (PanelData, PanelStore)
+
+        estimator = cls(y, x, panel.entities.tolist())
+        data = panel.select([estimator.depvar] + estimator.indvars)
+        for position, time in enumerate(panel.times.tolist()):
+            estimator.update(data[:, position, :], time)
+        return estimator
+
+
+class IncrementalFixedEffects(IncrementalEstimator):
+    def __init__(self, y, x, entities=None, variables=None):
+        """
+        Entity fixed effects updated one period at a time
+        :param y: name of the dependent variable
+        :param x: name of the independent variables
+        :param entities: array-like of entity labels known upfront
+        :param variables: names of the columns of array slices, [y] + x if not supplied
+        :return: nothing
+        """
+
+        super(IncrementalFixedEffects, self).__init__(y, x, entities, variables)
+        self.moments = WithinMoments(len(self.indvars))
+
+    def update(self, frame, time=None):
+        """
+        Add a new time period
+        :param frame: time slice (entities * variables), see IncrementalEstimator._align
+        :param time: label of the period
+        :return: nothing
+        """
+
+        self.moments.add(self._align(frame))
+        self.times.append(time if time is not None else len(self.times))
+
+    def estimate(self):
+        """
+        Solve the FE model on all periods added so far
+        :return: results
+        """
+
+        self.result = ols_results(self.moments.crossproducts(), self.depvar, self.indvars,
+                                  absorbed={'entity': self.moments.n_observed})
+        return self.result
+
+
+class IncrementalFirstDiff(IncrementalEstimator):
+    def __init__(self, y, x, entities=None, variables=None):
+        """
+        First differences updated one period at a time, only the previous period is kept
+        :param y: name of the dependent variable
+        :param x: name of the independent variables
+        :param entities: array-like of entity labels known upfront
+        :param variables: names of the columns of array slices, [y] + x if not supplied
+        :return: nothing
+        """
+
+        super(IncrementalFirstDiff, self).__init__(y, x, entities, variables)
+        self.products = CrossProducts(len(self.indvars))
+        self.previous = None
+
+    def update(self, frame, time=None):
+        """
+        Add a new time period, differenced against the previous one
+        :param frame: time slice (entities * variables), see IncrementalEstimator._align
+        :param time: label of the period
+        :return: nothing
+        """
+
+        values = self._align(frame)
+
+        if self.previous is not None:
+            previous = np.full(values.shape, np.nan)  # entities first seen in this period have no difference
+            previous[:self.previous.shape[0]] = self.previous
+            self.products.add(values - previous)
+
+        self.previous = values
+        self.times.append(time if time is not None else len(self.times))
+
+    def estimate(self):
+        """
+        Solve the FD model on all periods added so far
+        :return: results
+        """
+
+        self.result = ols_results(self.products, self.depvar, self.indvars)
+        return self.result
+
+
+def _identified(xtx, reference, tol=1e-10):
+    """
+    Whether transformed cross-products have full rank
+    Columns are scaled by the untransformed moments, so that what the transform leaves of a regressor
+    without variation (rounding noise) does not count as variation
+    :param xtx: k * k transformed cross-products of X
+    :param reference: k * k cross-products of X before the transform
+    :param tol: relative tolerance on the singular values
+    :return: bool
+    """
+
+    scale = np.sqrt(np.diag(reference))
+    scale[scale == 0] = 1.
+    return np.linalg.matrix_rank(xtx / np.outer(scale, scale), tol) == xtx.shape[0]
+
+
+def rolling(panel, y, x, window=None, model='fe', min_periods=None):
+    """
+    FE or FD estimates over rolling (or expanding) windows along the time axis
+    Every step adds the incoming period to the running sums and cross-products and removes the
+    outgoing one, so all windows together cost about as much as one fit on the whole panel
+    :param panel: PanelData or PanelStore
+    :param y: name of the dependent variable
+    :param x: name of the independent variables
+    :param window: number of periods per window, None for expanding windows from the first period
+    :param model: 'fe' for entity fixed effects or 'fd' for first differences (within the window)
+    :param min_periods: number of observed periods (with at least one complete row) a window needs to be estimated,
+    window (or 2 if expanding) if not supplied and never less than 2
+    :return: pandas DataFrame indexed by the last period of each window, columns ('params', x), ('bse', x) and 'nobs';
+    windows whose within X'X is singular are left out
+    """
+
+    assert type(panel) in (PanelData, PanelStore)
+    assert model in ('fe', 'fd')
+
+    if type(x) is str:
+        x = [x]
+    x = list(x)
+
+    if min_periods is None:
+        min_periods = window if window is not None else 2
+    assert window is None or min_periods <= window
+    min_periods = max(min_periods, 2)
+
+    data = panel.select([y] + x)
+    times = panel.times.tolist()
+
+    # running count of the periods with at least one complete row
+    observed = np.concatenate([[0], np.cumsum(np.isfinite(data).all(axis=2).any(axis=0))])
+
+    # running moments of the levels in the window, also the reference of the FD identification check:
+    # the differenced cross-products are built by adding and removing, what is left of a regressor that
+    # stopped varying is rounding noise of their own scale
+    moments = WithinMoments(len(x))
+    if model == 'fd':
+        products = CrossProducts(len(x))
+
+    labels = []
+    rows = []
+    for position in range(len(times)):
+        outgoing = position - window if window is not None else -1
+
+        moments.add(data[:, position])
+        if outgoing >= 0:
+            moments.remove(data[:, outgoing])
+
+        if model == 'fd':
+            # differences with both ends inside the window
+            if position > 0:
+                products.add(data[:, position] - data[:, position - 1])
+            if outgoing >= 0:
+                products.remove(data[:, outgoing + 1] - data[:, outgoing])
+
+        if observed[position + 1] - observed[max(outgoing + 1, 0)] < min_periods:
+            continue
+
+        current = moments.crossproducts() if model == 'fe' else products
+        if not _identified(current.xtx, moments.raw[1:, 1:]):
+            continue
+
+        absorbed = {'entity': moments.n_observed} if model == 'fe' else {}
+        if current.nobs - len(x) - sum(absorbed.values()) <= 0:
+            continue
+
+        results = ols_results(current, y, x, absorbed=absorbed)
+        labels.append(times[position])
+        rows.append(np.concatenate([results.params, results.bse, [results.nobs]]))
+
+    columns = pd.MultiIndex.from_tuples([('params', name) for name in x] + [('bse', name) for name in x] + [('nobs', '')])
+    table = pd.DataFrame(np.array(rows).reshape(len(rows), len(columns)), index=pd.Index(labels, name='time'), columns=columns)
+    table['nobs'] = table['nobs'].astype(np.int64)
+    return table
@@ -0,0 +1,132 @@
+"""
+Opt-in phase-level instrumentation of the builder and the estimators
+Records wall time, allocated bytes and array copies per phase and forwards
+every record to an optional callback (e.g. a metrics client)
+When disabled, the estimators use NO_INSTRUMENTATION whose methods do nothing
+"""
+
+import contextlib
+import time
+import tracemalloc
+
+
+class Instrumentation(object):
+    def __init__(self, callback=None, memory=True):
+        """
+        Initialize the instrumentation
+        :param callback: optional callable receiving every phase record (a dict) as it completes
+        :param memory: whether to trace allocations with tracemalloc (slows the instrumented code down)
+        :return: nothing
+        """
+
+        self.callback = callback
+        self.memory = memory
+        self.records = []
+
+        self._copies = 0
+        self._copied_bytes = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Measure one phase
+        :param name: name of the phase
+        :return: context manager
+        """
+
+        started_tracing = False
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+
+        self._copies = 0
+        self._copied_bytes = 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {
+                'phase': name,
+                'seconds': time.perf_counter() - start,
+                'copies': self._copies,
+                'copied_bytes': self._copied_bytes,
+            }
+            if self.memory:
+                after, peak = tracemalloc.get_traced_memory()
+                record['allocated_bytes'] = peak - before
+                record['retained_bytes'] = after - before
+                if started_tracing:
+                    tracemalloc.stop()
+
+            self.records.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    def copied(self, array):
+        """
+        Count a full array copy made in the current phase
+        :param array: the newly materialized numpy array
+        :return: the array
+        """
+
+        self._copies += 1
+        self._copied_bytes += array.nbytes
+        return array
+
+    def totals(self):
+        """
+        Sum the records by phase
+        :return: dict of phase name -> dict of summed numbers
+        """
+
+        totals = {}
+        for record in self.records:
+            summed = totals.setdefault(record['phase'], {})
+            for key, value in record.items():
+                if key != 'phase':
+                    summed[key] = summed.get(key, 0) + value
+        return totals
+
+
+class _NoInstrumentation(object):
+    records = []
+
+    def __init__(self):
+        self._context = _NullPhase()
+
+    def phase(self, name):
+        return self._context
+
+    def copied(self, array):
+        return array
+
+    def totals(self):
+        return {}
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_INSTRUMENTATION = _NoInstrumentation()  # shared, does nothing
+
+
+def get_instrumentation(instrument):
+    """
+    Resolve the instrument argument of the estimators
+    :param instrument: None or False (disabled), True (record without callback) or an Instrumentation
+    :return: Instrumentation or NO_INSTRUMENTATION
+    """
+
+    if instrument is None or instrument is False:
+        return NO_INSTRUMENTATION
+    if instrument is True:
+        return Instrumentation()
+    return instrument
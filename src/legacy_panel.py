@@ -0,0 +1,73 @@
+"""
+Conversion of legacy pandas Panel pickles to the on-disk panel format
+pandas.Panel is gone from pandas, so the pickle is read without it: the Panel, its
+BlockManager and its indexes are unpickled into plain placeholders and the axes and
+blocks are taken from their pickled state
+
+Usage:
+python legacy_panel.py ../data/nulled_panel ../data/nulled_panel_store
+"""
+
+import argparse
+import pickle
+import sys
+
+import numpy as np
+
+from panel_data import PanelData
+from panel_store import write_panel
+
+
+class _Pickled(object):
+    def __setstate__(self, state):
+        self.state = state
+
+
+def _new_index(cls, state):
+    return np.array(list(state['data']))  # object arrays of python 2 labels get their natural dtype
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module.startswith('pandas'):
+            return _new_index if name == '_new_Index' else _Pickled
+        return super(_LegacyUnpickler, self).find_class(module, name)
+
+
+def read_legacy_panel(path, dtype=np.float64):
+    """
+    Read a pickled pandas Panel (items are entities, major axis is time, minor axis are variables)
+    :param path: pickle file written by pandas.Panel.to_pickle
+    :param dtype: storage dtype of the panel
+    :return: PanelData
+    """
+
+    with open(path, 'rb') as stored:
+        panel = _LegacyUnpickler(stored, encoding='latin1').load()  # written by python 2
+
+    manager = panel.state['_data'].state
+    state = manager[3]['0.14.1']
+    entities, times, variables = state['axes']
+
+    values = np.full((len(entities), len(times), len(variables)), np.nan, dtype=dtype)
+    for block in state['blocks']:
+        values[block['mgr_locs']] = np.asarray(block['values'], dtype=dtype)  # missing cells are stored as 'NaN'
+
+    return PanelData(values, entities, times, variables, dtype=dtype)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert a legacy pandas Panel pickle to an on-disk panel')
+    parser.add_argument('pickle', help='pickled pandas Panel')
+    parser.add_argument('store', help='panel directory to write')
+    parser.add_argument('--overwrite', action='store_true', help='replace an existing panel directory')
+    args = parser.parse_args(argv)
+
+    panel = read_legacy_panel(args.pickle)
+    write_panel(panel, args.store, args.overwrite)
+    print(panel)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
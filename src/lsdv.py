@@ -0,0 +1,206 @@
+"""
+Least squares dummy variables (LSDV) on sparse one-hot blocks
+Entity, time and entity-specific slope dummies are scipy.sparse matrices with one nonzero
+per observation and block, so memory scales with the number of observations, never with
+observations * entities. Slopes come from the dummy-residualized variables (Frisch-Waugh-Lovell),
+the effects themselves from one more sparse least-squares solve on the residual
+"""
+
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from crossprod import CrossProducts, ols_results
+from instrument import NO_INSTRUMENTATION, get_instrumentation
+from panel_data import LongPanel, PanelData
+from panel_store import PanelStore
+
+
+def one_hot(codes, n_groups, values=None):
+    """
+    Sparse one-hot block, one nonzero per row
+    :param codes: 1D integer array of group codes per row
+    :param n_groups: number of groups (columns)
+    :param values: optional 1D array of the nonzero values (entity-specific slopes), ones if not supplied
+    :return: scipy.sparse csr_matrix (rows * n_groups)
+    """
+
+    from scipy import sparse
+
+    n_rows = codes.shape[0]
+    data = np.ones(n_rows) if values is None else np.asarray(values, dtype=np.float64)
+    return sparse.csr_matrix((data, codes, np.arange(n_rows + 1)), shape=(n_rows, n_groups))
+
+
+def sparse_solve(design, target, tol=1e-10, maxiter=None):
+    """
+    Sparse least squares with LSMR, columns scaled to unit norm for faster convergence
+    :param design: scipy.sparse matrix (rows * columns)
+    :param target: 1D array (rows)
+    :param tol: tolerance of LSMR (atol and btol)
+    :param maxiter: maximum number of LSMR iterations, its default if not supplied
+    :return: tuple of (coefficients, residuals, iterations), warns if LSMR stops before reaching tol
+    """
+
+    from scipy import sparse
+    from scipy.sparse.linalg import lsmr
+
+    norms = np.sqrt(np.asarray(design.multiply(design).sum(axis=0))).ravel()
+    norms[norms == 0] = 1.
+    scaled = design.dot(sparse.diags(1. / norms))
+
+    solution = lsmr(scaled, target, atol=tol, btol=tol, maxiter=maxiter)
+    if solution[1] not in (0, 1, 2):
+        # 0: the target is zero, 1 and 2: a (least squares) solution within tol
+        warnings.warn('LSMR did not converge to tol=%g in %d iterations (istop=%d)' % (tol, solution[2], solution[1]), RuntimeWarning)
+    coefficients = solution[0] / norms
+    return coefficients, target - design.dot(coefficients), solution[2]
+
+
+class SparseLSDV(object):
+    def __init__(self, panel, y, x, time=False, interact=None, tol=1e-10, maxiter=None, instrument=None):
+        """
+        Initialize the LSDV class
+        :param panel: PanelData, LongPanel or PanelStore (only the variables of the model are read from disk)
+        :param y: name of the dependent variable
+        :param x: name of the independent variables
+        :param time: whether to include time effects too
+        :param interact: list of variable names that get one slope per entity (not among x)
+        :param tol: tolerance of the LSMR solves
+        :param maxiter: maximum number of iterations of every LSMR solve
+        :param instrument: True or an Instrumentation to record time, memory and copies per phase, off by default
+        :return: nothing
+        """
+
+        assert type(panel) in (PanelData, LongPanel, PanelStore)
+
+        if type(x) is str:
+            x = [x]
+
+        if interact is None:
+            interact = []
+        elif type(interact) is str:
+            interact = [interact]
+
+        if type(panel) is PanelStore:
+            # page in only the variables the model uses
+            panel = panel.load([y] + list(x) + list(interact))
+
+        assert y in panel
+
+        for indvar in list(x) + list(interact):
+            assert indvar in panel
+            assert indvar != y
+
+        for variable in interact:
+            assert variable not in x
+
+        self.panel = panel
+        self.long = type(panel) is LongPanel
+
+        self.depvar = y
+        self.indvars = list(x)
+        self.interact = list(interact)
+        self.time = time
+        self.tol = tol
+        self.maxiter = maxiter
+
+        self.instrument = get_instrumentation(instrument)
+
+        self.effects = None
+        self.iterations = 0
+        self.result = None
+
+    def __design(self):
+        """
+        Complete rows of [y, X] and the sparse dummy blocks over them
+        :return: tuple of (2D array of rows, sparse dummy matrix, list of (effect name, labels, first column))
+        """
+
+        from scipy import sparse
+
+        variables = [self.depvar] + self.indvars + self.interact
+        data = self.panel.select(variables)
+        flat = data.reshape(-1, len(variables))
+        valid = np.isfinite(flat).all(axis=1)
+        rows = np.flatnonzero(valid)
+
+        if self.long:
+            entity_codes = self.panel.entity_codes[rows]
+            time_codes = self.panel.time_codes[rows]
+        else:
+            n_times = data.shape[1]
+            entity_codes = rows // n_times
+            time_codes = rows % n_times
+
+        values = flat[rows].astype(np.float64, copy=False)
+
+        # only entities and periods with observations get a column
+        entity_codes, entity_positions = pd.factorize(entity_codes, sort=True)
+        entities = self.panel.entities[entity_positions]
+
+        blocks = [one_hot(entity_codes, len(entities))]
+        layout = [('entity', entities, 0)]
+        columns = len(entities)
+
+        if self.time:
+            time_codes, time_positions = pd.factorize(time_codes, sort=True)
+            times = self.panel.times[time_positions]
+            # the first period is the reference, collinear with the entity effects
+            blocks.append(one_hot(time_codes, len(times))[:, 1:])
+            layout.append(('time', times[1:], columns))
+            columns += len(times) - 1
+
+        for position, variable in enumerate(self.interact):
+            blocks.append(one_hot(entity_codes, len(entities), values[:, 1 + len(self.indvars) + position]))
+            layout.append(('slope ' + str(variable), entities, columns))
+            columns += len(entities)
+
+        dummies = sparse.hstack(blocks, format='csr')
+        return values[:, :1 + len(self.indvars)], dummies, layout
+
+    def estimate(self, verbose=False):
+        """
+        Estimate the slopes and recover every effect
+        :param verbose: whether to print the summary
+        :return: results
+        """
+
+        instrument = self.instrument
+        first_record = len(instrument.records)  # phases of this call only
+
+        with instrument.phase('design'):
+            values, dummies, layout = self.__design()
+
+        with instrument.phase('solve'):
+            # residualize y and every regressor on the dummies, then OLS on the residuals
+            residualized = np.empty_like(values)
+            self.iterations = 0
+            for column in range(values.shape[1]):
+                _, residualized[:, column], iterations = sparse_solve(dummies, values[:, column], self.tol, self.maxiter)
+                self.iterations += iterations
+
+            products = CrossProducts.from_array(residualized)
+            results = ols_results(products, self.depvar, self.indvars)
+
+            # the effects absorb what the slopes leave over
+            effects, _, iterations = sparse_solve(dummies, values[:, 0] - np.dot(values[:, 1:], results.params),
+                                                  self.tol, self.maxiter)
+            self.iterations += iterations
+
+        # degrees of freedom net of the dummies
+        results.df_resid -= dummies.shape[1]
+        results.cov_params = results.cov_params * (products.nobs - products.k) / results.df_resid
+
+        self.effects = dict((name, pd.Series(effects[start:start + len(labels)], index=labels))
+                            for name, labels, start in layout)
+
+        if instrument is not NO_INSTRUMENTATION:
+            results.phases = instrument.records[first_record:]
+
+        if verbose:
+            print(results.summary())
+
+        self.result = results
+        return results
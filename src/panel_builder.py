@@ -1,5 +1,5 @@
 """
-Build a Pandas panel from disparate data sources
+Build a PanelData panel from disparate data sources
 Pandas dataframes
 Numpy arrays
 ...
@@ -10,6 +10,10 @@ A utility for simplifying work with FE/FD classes
 import pandas as pd
 import numpy as np
 
+from instrument import get_instrumentation
+from panel_data import LongPanel, PanelData
+from panel_store import PanelStore, write_panel
+
 
 class PanelBuilder(object):
     def __init__(self):
@@ -24,12 +28,13 @@ class PanelBuilder(object):
         self.entities = None
         self.variables = None
 
-        self.data_dict = {}
-        self.dict_key = 'time'
+        self.data_dict = None  # 3D array (entities * times * variables), filled as data is passed
+        self.dict_key = 'array'
 
         self.dimensions = [0,0,0] # items * times * variables
 
         self.panel = None
+        self.instrumentation = None  # records of the last save_panel, if instrumented
 
     def specify_times(self, times):
         """
@@ -46,7 +51,7 @@ class PanelBuilder(object):
         elif type(times) is tuple:
             times = np.array(list(times))
 
-        assert type(times) is np.array
+        assert type(times) is np.ndarray
 
         times = times.flatten() # just in case if it were passed as (1,x) or something
 
@@ -78,7 +83,7 @@ class PanelBuilder(object):
         elif type(entities) is tuple:
             entities = np.array(list(entities))
 
-        assert type(entities) is np.array
+        assert type(entities) is np.ndarray
 
         entities = entities.flatten()
 
@@ -110,7 +115,7 @@ class PanelBuilder(object):
         elif type(variables) is tuple:
             variables = np.array(list(variables))
 
-        assert type(variables) is np.array
+        assert type(variables) is np.ndarray
 
         variables = variables.flatten()
 
@@ -130,134 +135,136 @@ class PanelBuilder(object):
     def frames_by_time(self, use_index=False, use_columns=False, *frames):
         """
         Pass frames (entity * variable) by year as arguments
-        :param use_index: whether to use index from dataframes (if they are pandas dataframes)
-        :param use_columns: whether to use column names from dataframes (if they are pandas dataframes)
-        :param frames: list of frame-like (pandas dataframe or 2D numpy array or multidimensional list)
+        :param use_index: whether to use index from dataframes (if they are pandas dataframes), rows are then aligned
+        to the entities by label
+        :param use_columns: whether to use column names from dataframes (if they are pandas dataframes), columns are then
+        aligned to the variables by name
+        :param frames: list of frame-like (pandas dataframe or 2D numpy array or multidimensional list),
+        or a single iterator / generator of them
         :return: nothing
         """
 
-        # check if fits with already supplied times
-        count = len(frames)
-        if self.dimensions[1] > 0:
-            assert count == self.dimensions[1]
-        else:
-            print('Time dimension not yet set, using the number of passed dataframes: %d' % count)
-            print('Setting the time periods to be a list of integers starting from 0')
-            self.dimensions[1] = count
-            self.time_series = np.arange(count)
-
-        # iterate over each frame
-        self.dict_key = 'time'
-        checked_indices = False
-        for time, frame in zip(self.time_series, frames):
-            # check if it is a pandas frame
-            if type(frame) is pd.DataFrame:
-                frame_values = frame.values
-
-                # check dimensionality and use index/column names if requred
-                if not checked_indices:
-                    if self.dimensions[0] == 0:
-                        print('Entity dimension not yet set, using the number of rows in first dataframe: %d' % frame_values.shape[0])
-                        self.dimensions[0] = frame_values.shape[0]
-                        self.entities = frame.index.values if use_index else np.arange(self.dimensions[0])
-                    if self.dimensions[2] == 0:
-                        print('Variable dimension not yet set, using the number of columns in first dataframe: %d' % frame_values.shape[1])
-                        self.dimensions[2] = frame_values.shape[1]
-                        self.variables = frame.columns.values if use_columns else np.arange(self.dimensions[2])
-                    checked_indices = True
-
-                assert frame_values.shape is (self.dimensions[0], self.dimensions[2])
-
-                self.data_dict[time] = pd.DataFrame(frame_values, index=self.entities, columns=self.variables)
-
-            # if it is a multilist
-            else:
-                if type(frame) is list:
-                    frame = np.array(frame)
-
-                # if it is a np.array
-                assert type(frame) is np.array
-
-                if not checked_indices:
-                    if self.dimensions[0] == 0:
-                        print('Entity dimension not yet set, using the number of rows in first dataframe: %d' % frame.shape[0])
-                        self.dimensions[0] = frame.shape[0]
-                        self.entities = np.arange(self.dimensions[0])
-                    if self.dimensions[2] == 0:
-                        print('Variable dimension not yet set, using the number of columns in first dataframe: %d' % frame.shape[1])
-                        self.dimensions[2] = frame.shape[1]
-                        self.variables = np.arange(self.dimensions[2])
-                    checked_indices = True
-
-                assert frame.shape is (self.dimensions[0], self.dimensions[2])
-
-                self.data_dict[time] = pd.DataFrame(frame, index=self.entities, columns=self.variables)
+        self.__ingest(frames, 1, use_index, use_columns)
 
     def frames_by_entity(self, use_index=False, use_columns=False, *frames):
         """
         Pass frames (time * variables) by entity as list
-        :param use_index: whether to use index from dataframes (time, if they are pandas)
-        :param use_columns: whether to use columns from dataframes (variables, if they are pandas)
-        :param frames: list of frame-like data
+        :param use_index: whether to use index from dataframes (time, if they are pandas), rows are then aligned
+        to the times by label
+        :param use_columns: whether to use columns from dataframes (variables, if they are pandas), columns are then
+        aligned to the variables by name
+        :param frames: list of frame-like data, or a single iterator / generator of them
         :return: nothing
         """
 
-        # check if fits with already supplied entities
-        count = len(frames)
-        if self.dimensions[0] > 0:
-            assert count == self.dimensions[0]
+        self.__ingest(frames, 0, use_index, use_columns)
+
+    def __ingest(self, frames, axis, use_index, use_columns):
+        """
+        Copy 2D slices straight into one preallocated (entities * times * variables) buffer
+        Labels are aligned through a label -> position index built once, and only recomputed
+        for a slice whose labels differ from the previous one
+        :param frames: tuple of frame-like slices, or a 1-tuple holding an iterator of them (consumed once)
+        :param axis: dimension the slices are taken along, 1 for time (rows are entities), 0 for entity (rows are times)
+        :param use_index: whether to align dataframe rows by their index
+        :param use_columns: whether to align dataframe columns by their names
+        :return: nothing
+        """
+
+        names = ('Entity', 'Time', 'Variable')
+        labels = ('entities', 'time_series', 'variables')
+        rows = 1 - axis
+
+        count = None
+        if len(frames) == 1 and iter(frames[0]) is frames[0]:
+            frames = frames[0]  # stream, the number of slices is known at the end
         else:
-            print('Entity dimension not yet set, using the number of passed dataframes: %d' % count)
-            print('Setting the entities to be a list of integers starting from 0')
-            self.dimensions[0] = count
-            self.entities = np.arange(count)
-
-        # iterate over each frame
-        self.dict_key = 'entity'
-        checked_indices = False
-        for item, frame in zip(self.entities, frames):
-            # check if it is a pandas frame
-            if type(frame) is pd.DataFrame:
-                frame_values = frame.values
+            count = len(frames)
+            if self.dimensions[axis] > 0:
+                assert count == self.dimensions[axis]
 
-                # check dimensionality and use index/column names if requred
-                if not checked_indices:
-                    if self.dimensions[1] == 0:
-                        print('Time dimension not yet set, using the number of rows in first dataframe: %d' % frame_values.shape[0])
-                        self.dimensions[1] = frame_values.shape[0]
-                        self.time_series = frame.index.values if use_index else np.arange(self.dimensions[0])
-                    if self.dimensions[2] == 0:
-                        print('Variable dimension not yet set, using the number of columns in first dataframe: %d' % frame_values.shape[1])
-                        self.dimensions[2] = frame_values.shape[1]
-                        self.variables = frame.columns.values if use_columns else np.arange(self.dimensions[2])
-                    checked_indices = True
+        capacity = self.dimensions[axis] or count
 
-                assert frame_values.shape is (self.dimensions[1], self.dimensions[2])
+        buffer = None
+        row_index = column_index = None
+        row_positions = column_positions = None
+        last_rows = last_columns = None
 
-                self.data_dict[item] = pd.DataFrame(frame_values, index=self.time_series, columns=self.variables)
+        filled = 0
+        for frame in frames:
+            index = columns = None
+            if type(frame) is pd.DataFrame:
+                index, columns = frame.index, frame.columns
+                frame = frame.values
+            elif type(frame) is list:
+                frame = np.array(frame)
+
+            assert type(frame) is np.ndarray
+            assert len(frame.shape) == 2
+
+            if buffer is None:
+                # the first slice sets the missing row and variable dimensions
+                for dimension, size, supplied, use in ((rows, frame.shape[0], index, use_index), (2, frame.shape[1], columns, use_columns)):
+                    if self.dimensions[dimension] == 0:
+                        print('%s dimension not yet set, using the number of %s in first dataframe: %d' % (
+                            names[dimension], 'rows' if dimension == rows else 'columns', size))
+                        self.dimensions[dimension] = size
+                        setattr(self, labels[dimension], supplied.values if use and supplied is not None else np.arange(size))
+
+                row_index = pd.Index(getattr(self, labels[rows]))
+                column_index = pd.Index(self.variables)
+                assert row_index.is_unique and column_index.is_unique
+
+                shape = list(self.dimensions)
+                shape[axis] = capacity or 1
+                buffer = np.full(shape, np.nan)
+
+            if filled == buffer.shape[axis]:
+                # streamed slices of unknown number, grow geometrically
+                assert self.dimensions[axis] == 0
+                buffer = np.concatenate([buffer, np.full(buffer.shape, np.nan)], axis=axis)
+
+            target = buffer[:, filled] if axis == 1 else buffer[filled]
+
+            if use_index and index is not None:
+                if last_rows is None or not index.equals(last_rows):
+                    row_positions = row_index.get_indexer(index)
+                    assert (row_positions >= 0).all(), 'unknown %s labels' % names[rows].lower()
+                    last_rows = index
+            else:
+                row_positions = None
+                assert frame.shape[0] == self.dimensions[rows]
+
+            if use_columns and columns is not None:
+                if last_columns is None or not columns.equals(last_columns):
+                    column_positions = column_index.get_indexer(columns)
+                    assert (column_positions >= 0).all(), 'unknown variables'
+                    last_columns = columns
+            else:
+                column_positions = None
+                assert frame.shape[1] == self.dimensions[2]
 
-            # if it is a multilist
+            if row_positions is None and column_positions is None:
+                target[...] = frame
             else:
-                if type(frame) is list:
-                    frame = np.array(frame)
+                target[np.ix_(np.arange(target.shape[0]) if row_positions is None else row_positions,
+                              np.arange(target.shape[1]) if column_positions is None else column_positions)] = frame
 
-                # if it is a np.array
-                assert type(frame) is np.array
+            filled += 1
 
-                if not checked_indices:
-                    if self.dimensions[1] == 0:
-                        print('Time dimension not yet set, using the number of rows in first dataframe: %d' % frame.shape[0])
-                        self.dimensions[1] = frame.shape[0]
-                        self.time_series = np.arange(self.dimensions[0])
-                    if self.dimensions[2] == 0:
-                        print('Variable dimension not yet set, using the number of columns in first dataframe: %d' % frame.shape[1])
-                        self.dimensions[2] = frame.shape[1]
-                        self.variables = np.arange(self.dimensions[2])
-                    checked_indices = True
+        assert filled > 0
 
-                assert frame.shape is (self.dimensions[1], self.dimensions[2])
+        if self.dimensions[axis] == 0:
+            print('%s dimension not yet set, using the number of passed dataframes: %d' % (names[axis], filled))
+            print('Setting the %s to be a list of integers starting from 0' % ('time periods' if axis == 1 else 'entities'))
+            self.dimensions[axis] = filled
+            setattr(self, labels[axis], np.arange(filled))
+            buffer = buffer[:, :filled] if axis == 1 else buffer[:filled]
+        else:
+            assert filled == self.dimensions[axis]
 
-                self.data_dict[item] = pd.DataFrame(frame, index=self.time_series, columns=self.variables)
+        self.dict_key = 'array'
+        self.data_dict = np.ascontiguousarray(buffer)  # no copy unless a stream was trimmed
 
     def panel_from_array(self, multiarray):
         """
@@ -268,7 +275,7 @@ class PanelBuilder(object):
 
         if type(multiarray) is list:
             multiarray = np.array(multiarray)
-        assert type(multiarray) is np.array
+        assert type(multiarray) is np.ndarray
         assert len(multiarray.shape) == 3
 
         if 0 not in self.dimensions:
@@ -277,46 +284,89 @@ class PanelBuilder(object):
             shape = multiarray.shape
             if self.dimensions[0] == 0:
                 print('Entity dimension not yet set, using the first dimension in array %d' % shape[0])
-                self.dimensions[0] == shape[0]
+                self.dimensions[0] = shape[0]
                 self.entities = np.arange(shape[0])
             assert self.dimensions[0] == shape[0]
 
             if self.dimensions[1] == 0:
                 print('Time dimension not yet set, using the second dimension in array %d' % shape[1])
-                self.dimensions[1] == shape[1]
+                self.dimensions[1] = shape[1]
                 self.time_series = np.arange(shape[1])
             assert self.dimensions[1] == shape[1]
 
             if self.dimensions[2] == 0:
                 print('Variable dimension not yet set, using the third dimension in array %d' % shape[2])
-                self.dimensions[2] == shape[2]
+                self.dimensions[2] = shape[2]
                 self.variables = np.arange(shape[2])
             assert self.dimensions[2] == shape[2]
 
         self.dict_key = 'array'
         self.data_dict = multiarray
 
-    def save_panel(self):
+    def panel_from_long(self, frame, entity=None, time=None, variables=None):
+        """
+        Make a long-format panel from a dataframe with one row per observed (entity, time)
+        The rows are kept as they are, no entities * times rectangle is built
+        :param frame: pandas DataFrame
+        :param entity: name of the entity column, the first index level if not supplied
+        :param time: name of the time column, the second index level if not supplied
+        :param variables: columns to use, all remaining columns if not supplied
+        :return: LongPanel
+        """
+
+        panel = LongPanel.from_frame(frame, entity, time, variables)
+
+        self.entities = panel.entities
+        self.time_series = panel.times
+        self.variables = panel.variables
+        self.dimensions = [len(panel.entities), len(panel.times), len(panel.variables)]
+
+        print(panel)
+        self.panel = panel
+        return panel
+
+    def save_panel(self, dtype=np.float64, instrument=None):
         """
-        Take all supplied data and create the final pandas Panel
-        :return: pandas Panel
+        Take all supplied data and create the final PanelData
+        :param dtype: storage dtype of the panel, np.float64 or np.float32
+        :param instrument: True or an Instrumentation to record time, memory and copies per phase, off by default
+        :return: PanelData
         """
 
         assert 0 not in self.dimensions
-        assert self.data_dict != {}
-
-        if self.dict_key == 'time':
-            assert len(self.data_dict) == self.dimensions[1]
-            panel = pd.Panel(self.data_dict, index=self.time_series, major_axis=self.entities, minor_axis=self.variables).transpose(1,0,2) # put entities into items
-        elif self.dict_key == 'entity':
-            assert len(self.data_dict) == self.dimensions[0]
-            panel = pd.Panel(self.data_dict, major_axis=self.time_series, index=self.entities, minor_axis=self.variables)
-        else:
-            # not a dict, but a 3D np array
-            panel = pd.Panel(self.data_dict, major_axis=self.time_series, index=self.entities, minor_axis=self.variables)
+        assert self.data_dict is not None  # slices are copied into place when they are passed
+
+        instrument = get_instrumentation(instrument)
+
+        values = self.data_dict
+
+        with instrument.phase('convert'):
+            panel = PanelData(values, self.entities, self.time_series, self.variables, dtype=dtype)
+            if not np.shares_memory(panel.values, values):
+                instrument.copied(panel.values)
+
+        self.instrumentation = instrument
 
         print(panel)
         self.panel = panel
         return panel
 
+    def write_panel(self, path, overwrite=False, dtype=np.float64):
+        """
+        Write the panel to a directory in the on-disk format (one memory-mapped file per variable)
+        The panel is created first if save_panel was not called yet
+        :param path: directory to create
+        :param overwrite: whether to replace an existing panel directory
+        :param dtype: storage dtype of the panel, if it still has to be created
+        :return: PanelStore opened on the directory
+        """
+
+        if self.panel is None:
+            self.save_panel(dtype)
+
+        panel = self.panel
+        if type(panel) is LongPanel:
+            panel = panel.to_panel()
 
+        write_panel(panel, path, overwrite)
+        return PanelStore(path)
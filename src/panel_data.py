@@ -0,0 +1,305 @@
+"""
+Compact array-backed panel container
+One contiguous (entities * times * variables) float buffer plus the index of every axis
+Replaces pandas Panel, which is gone from modern pandas
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class PanelData(object):
+    __slots__ = ('values', 'entities', 'times', 'variables', 'mask', '_positions', '_keys')
+
+    def __init__(self, values, entities=None, times=None, variables=None, mask=None, dtype=np.float64):
+        """
+        Initialize the panel
+        :param values: 3D array-like (entities * times * variables), missing cells are NaN
+        :param entities: array-like of entity labels, integers from 0 if not supplied
+        :param times: array-like of time labels, integers from 0 if not supplied
+        :param variables: array-like of variable names, integers from 0 if not supplied
+        :param mask: optional 2D boolean array (entities * times) of valid cells, cells outside it are treated as missing
+        :param dtype: storage dtype, np.float64 or np.float32
+        :return: nothing
+        """
+
+        assert np.dtype(dtype) in (np.dtype(np.float64), np.dtype(np.float32))
+
+        values = np.ascontiguousarray(values, dtype=dtype)  # no copy if already contiguous with the right dtype
+        assert values.ndim == 3
+
+        n_entities, n_times, n_variables = values.shape
+
+        self.values = values
+        self.entities = np.asarray(entities) if entities is not None else np.arange(n_entities)
+        self.times = np.asarray(times) if times is not None else np.arange(n_times)
+        self.variables = np.asarray(variables) if variables is not None else np.arange(n_variables)
+
+        assert self.entities.shape == (n_entities,)
+        assert self.times.shape == (n_times,)
+        assert self.variables.shape == (n_variables,)
+
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            assert mask.shape == (n_entities, n_times)
+        self.mask = mask
+
+        self._positions = dict((variable, position) for position, variable in enumerate(self.variables.tolist()))
+        self._keys = {}  # cache fingerprints, see transform_cache.fingerprint
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    def __repr__(self):
+        return '<PanelData>\nDimensions: %d (entities) x %d (times) x %d (variables)\ndtype: %s' % (self.shape + (self.dtype,))
+
+    def __contains__(self, variable):
+        return variable in self._positions
+
+    def position(self, variable):
+        """
+        Position of a variable along the last axis
+        :param variable: variable name
+        :return: integer
+        """
+
+        return self._positions[variable]
+
+    def var(self, variable):
+        """
+        Zero-copy view of one variable
+        :param variable: variable name
+        :return: 2D array view (entities * times)
+        """
+
+        return self.values[:, :, self._positions[variable]]
+
+    def entity(self, label):
+        """
+        Zero-copy view of one entity
+        :param label: entity label
+        :return: 2D contiguous array view (times * variables)
+        """
+
+        return self.values[np.flatnonzero(self.entities == label)[0]]
+
+    def select(self, variables):
+        """
+        Extract some variables into a contiguous array, cells outside the mask are set to NaN
+        :param variables: list of variable names, in order
+        :return: 3D array (entities * times * len(variables))
+        """
+
+        positions = [self._positions[variable] for variable in variables]
+        selected = np.take(self.values, positions, axis=2)  # a single gather into a new contiguous buffer
+        if self.mask is not None:
+            selected[~self.mask] = np.nan
+        return selected
+
+    def valid(self, variables=None):
+        """
+        Cells where all the given variables are observed
+        :param variables: list of variable names, all variables if not supplied
+        :return: 2D boolean array (entities * times)
+        """
+
+        values = self.values if variables is None else self.select(variables)
+        valid = np.isfinite(values).all(axis=2)
+        if self.mask is not None:
+            valid &= self.mask
+        return valid
+
+    def to_frame(self, dropna=False):
+        """
+        Long-format dataframe indexed by (entity, time), one column per variable
+        :param dropna: whether to drop cells that are invalid or have no observed variable
+        :return: pandas DataFrame
+        """
+
+        n_entities, n_times, n_variables = self.shape
+        index = pd.MultiIndex.from_product([self.entities, self.times], names=['entity', 'time'])
+        frame = pd.DataFrame(self.values.reshape(n_entities * n_times, n_variables), index=index, columns=self.variables, copy=False)
+
+        if dropna:
+            keep = np.isfinite(self.values).any(axis=2)
+            if self.mask is not None:
+                keep &= self.mask
+            frame = frame[keep.ravel()]
+        return frame
+
+    @classmethod
+    def from_frame(cls, frame, entity=None, time=None, variables=None, dtype=np.float64):
+        """
+        Build the panel from a long-format dataframe in one scatter
+        :param frame: pandas DataFrame, one row per (entity, time)
+        :param entity: name of the entity column, the first index level if not supplied
+        :param time: name of the time column, the second index level if not supplied
+        :param variables: columns to use, all remaining columns if not supplied
+        :param dtype: storage dtype
+        :return: PanelData
+        """
+
+        if entity is None:
+            entity_labels = frame.index.get_level_values(0).values
+            time_labels = frame.index.get_level_values(1).values
+        else:
+            entity_labels = frame[entity].values
+            time_labels = frame[time].values
+
+        if variables is None:
+            variables = [column for column in frame.columns if column not in (entity, time)]
+
+        entity_codes, entities = pd.factorize(entity_labels, sort=True)
+        time_codes, times = pd.factorize(time_labels, sort=True)
+
+        values = np.full((len(entities), len(times), len(variables)), np.nan, dtype=dtype)
+        values[entity_codes, time_codes] = frame[list(variables)].values
+
+        return cls(values, np.asarray(entities), np.asarray(times), np.asarray(variables), dtype=dtype)
+
+    @classmethod
+    def from_panel(cls, panel, dtype=np.float64):
+        """
+        Convert a legacy pandas Panel (items are entities, major axis is time, minor axis are variables)
+        :param panel: pandas Panel
+        :param dtype: storage dtype
+        :return: PanelData
+        """
+
+        entities, times, variables = panel.axes
+        return cls(np.asarray(panel.values, dtype=dtype), entities.values, times.values, variables.values, dtype=dtype)
+
+
+class LongPanel(object):
+    __slots__ = ('values', 'entity_codes', 'time_codes', 'entities', 'times', 'variables', '_positions')
+
+    def __init__(self, values, entity_codes, time_codes, entities, times, variables, dtype=np.float64):
+        """
+        Initialize the long-format panel: only observed (entity, time) rows are stored,
+        memory scales with the number of rows instead of the full entities * times rectangle
+        :param values: 2D array-like (rows * variables), rows sorted by entity and time
+        :param entity_codes: 1D integer array, position of each row's entity in entities
+        :param time_codes: 1D integer array, position of each row's period in times
+        :param entities: array-like of entity labels
+        :param times: array-like of sorted time labels
+        :param variables: array-like of variable names
+        :param dtype: storage dtype, np.float64 or np.float32
+        :return: nothing
+        """
+
+        assert np.dtype(dtype) in (np.dtype(np.float64), np.dtype(np.float32))
+
+        self.values = np.ascontiguousarray(values, dtype=dtype)
+        self.entity_codes = np.asarray(entity_codes, dtype=np.intp)
+        self.time_codes = np.asarray(time_codes, dtype=np.intp)
+        self.entities = np.asarray(entities)
+        self.times = np.asarray(times)
+        self.variables = np.asarray(variables)
+
+        assert self.values.ndim == 2
+        assert self.entity_codes.shape == self.time_codes.shape == (self.values.shape[0],)
+        assert self.variables.shape == (self.values.shape[1],)
+
+        self._positions = dict((variable, position) for position, variable in enumerate(self.variables.tolist()))
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nobs(self):
+        return self.values.shape[0]
+
+    def __repr__(self):
+        return '<LongPanel>\nDimensions: %d (rows) of %d (entities) x %d (times) x %d (variables)' % (
+            self.nobs, len(self.entities), len(self.times), len(self.variables))
+
+    def __contains__(self, variable):
+        return variable in self._positions
+
+    def var(self, variable):
+        """
+        Zero-copy view of one variable
+        :param variable: variable name
+        :return: 1D array view (rows)
+        """
+
+        return self.values[:, self._positions[variable]]
+
+    def entity(self, label):
+        """
+        Zero-copy view of the rows of one entity
+        :param label: entity label
+        :return: 2D array view (rows of the entity * variables)
+        """
+
+        code = np.flatnonzero(self.entities == label)[0]
+        start, stop = np.searchsorted(self.entity_codes, [code, code + 1])
+        return self.values[start:stop]
+
+    def select(self, variables):
+        """
+        Extract some variables into a contiguous array
+        :param variables: list of variable names, in order
+        :return: 2D array (rows * len(variables))
+        """
+
+        return np.take(self.values, [self._positions[variable] for variable in variables], axis=1)
+
+    def to_frame(self):
+        """
+        Long-format dataframe indexed by (entity, time), one column per variable
+        :return: pandas DataFrame
+        """
+
+        index = pd.MultiIndex.from_arrays([self.entities[self.entity_codes], self.times[self.time_codes]], names=['entity', 'time'])
+        return pd.DataFrame(self.values, index=index, columns=self.variables, copy=False)
+
+    def to_panel(self):
+        """
+        Scatter the rows into a dense panel
+        :return: PanelData
+        """
+
+        values = np.full((len(self.entities), len(self.times), len(self.variables)), np.nan, dtype=self.dtype)
+        values[self.entity_codes, self.time_codes] = self.values
+        return PanelData(values, self.entities, self.times, self.variables, dtype=self.dtype)
+
+    @classmethod
+    def from_frame(cls, frame, entity=None, time=None, variables=None, dtype=np.float64):
+        """
+        Factorize entity and time once and sort the rows by them
+        :param frame: pandas DataFrame, one row per observed (entity, time)
+        :param entity: name of the entity column, the first index level if not supplied
+        :param time: name of the time column, the second index level if not supplied
+        :param variables: columns to use, all remaining columns if not supplied
+        :param dtype: storage dtype
+        :return: LongPanel
+        """
+
+        if entity is None:
+            entity_labels = frame.index.get_level_values(0).values
+            time_labels = frame.index.get_level_values(1).values
+        else:
+            entity_labels = frame[entity].values
+            time_labels = frame[time].values
+
+        if variables is None:
+            variables = [column for column in frame.columns if column not in (entity, time)]
+
+        entity_codes, entities = pd.factorize(entity_labels, sort=True)
+        time_codes, times = pd.factorize(time_labels, sort=True)
+
+        order = np.lexsort((time_codes, entity_codes))
+        values = frame[list(variables)].values.astype(dtype)[order]
+
+        return cls(values, entity_codes[order], time_codes[order], np.asarray(entities), np.asarray(times), np.asarray(variables), dtype)
@@ -3,9 +3,13 @@ Wrapper object for all utilities and estimation models
 
 """
 
+from batch import fit_many
 from fixed_effects import FixedEffects
 from first_diff import FirstDiff
+from incremental import IncrementalFirstDiff, IncrementalFixedEffects, rolling
+from lsdv import SparseLSDV
 from panel_builder import PanelBuilder
+from random_effects import BetweenEstimator, RandomEffects
 
 
 class PanelReg(object):
@@ -32,6 +36,62 @@ class PanelReg(object):
 
         return FixedEffects
 
+    def lsdv(self):
+        """
+        Returns the sparse LSDV object, which also recovers the fixed effects
+        :return: SparseLSDV
+        """
+
+        return SparseLSDV
+
+    def be(self):
+        """
+        Returns the Between object
+        :return: BetweenEstimator
+        """
+
+        return BetweenEstimator
+
+    def re(self):
+        """
+        Returns the Random Effects object
+        :return: RandomEffects
+        """
+
+        return RandomEffects
+
+    def batch(self):
+        """
+        Returns the function fitting many specifications at once
+        :return: fit_many
+        """
+
+        return fit_many
+
+    def fe_incremental(self):
+        """
+        Returns the FE object updated one period at a time
+        :return: IncrementalFixedEffects
+        """
+
+        return IncrementalFixedEffects
+
+    def fd_incremental(self):
+        """
+        Returns the First Diff object updated one period at a time
+        :return: IncrementalFirstDiff
+        """
+
+        return IncrementalFirstDiff
+
+    def rolling(self):
+        """
+        Returns the function estimating FE or FD over rolling and expanding windows
+        :return: rolling
+        """
+
+        return rolling
+
     def build(self):
         """
         Returns the panel building object
@@ -0,0 +1,175 @@
+"""
+On-disk panel format
+A directory with one .npy array (entities * times) per variable, an index.json with the entity,
+time and variable labels and a metadata.json with the shape, dtype and file of every variable
+Variables are memory-mapped when opened, so only the ones that are used are ever read
+"""
+
+import json
+import os
+
+import numpy as np
+
+from panel_data import PanelData
+
+FORMAT_VERSION = 1
+METADATA_FILE = 'metadata.json'
+INDEX_FILE = 'index.json'
+MASK_FILE = 'mask.npy'
+
+
+def _encode_labels(labels):
+    """
+    JSON representation of an axis index
+    :param labels: 1D numpy array of labels
+    :return: dict with the dtype and the list of labels
+    """
+
+    if labels.dtype.kind in 'mM':
+        values = labels.astype(str).tolist()  # ISO strings, restored with the dtype
+    else:
+        values = labels.tolist()
+    return {'dtype': labels.dtype.str if labels.dtype.kind != 'O' else 'object', 'labels': values}
+
+
+def _decode_labels(encoded):
+    """
+    Axis index from its JSON representation
+    :param encoded: dict with the dtype and the list of labels
+    :return: 1D numpy array of labels
+    """
+
+    if encoded['dtype'] == 'object':
+        labels = np.empty(len(encoded['labels']), dtype=object)
+        labels[:] = encoded['labels']
+        return labels
+    return np.array(encoded['labels'], dtype=np.dtype(encoded['dtype']))
+
+
+def write_panel(panel, path, overwrite=False):
+    """
+    Write a panel to a directory in the on-disk format
+    :param panel: PanelData
+    :param path: directory to create
+    :param overwrite: whether to replace the files of an existing panel directory
+    :return: nothing
+    """
+
+    assert type(panel) is PanelData
+
+    if os.path.exists(path):
+        assert overwrite, '%s already exists' % path
+        assert os.path.isdir(path)
+    else:
+        os.makedirs(path)
+
+    files = []
+    for position in range(panel.shape[2]):
+        name = 'var_%05d.npy' % position  # variable names need not be valid file names
+        np.save(os.path.join(path, name), np.ascontiguousarray(panel.values[:, :, position]))
+        files.append(name)
+
+    if panel.mask is not None:
+        np.save(os.path.join(path, MASK_FILE), panel.mask)
+    elif os.path.exists(os.path.join(path, MASK_FILE)):
+        os.remove(os.path.join(path, MASK_FILE))
+
+    index = {
+        'entities': _encode_labels(panel.entities),
+        'times': _encode_labels(panel.times),
+        'variables': _encode_labels(panel.variables),
+    }
+    metadata = {
+        'version': FORMAT_VERSION,
+        'shape': list(panel.shape),
+        'dtype': panel.dtype.str,
+        'files': files,
+        'mask': panel.mask is not None,
+    }
+
+    with open(os.path.join(path, INDEX_FILE), 'w') as output:
+        json.dump(index, output)
+    # metadata last, a directory without it is an incomplete write
+    with open(os.path.join(path, METADATA_FILE), 'w') as output:
+        json.dump(metadata, output, indent=2)
+
+
+class PanelStore(object):
+    def __init__(self, path):
+        """
+        Open a panel directory lazily, only the index and metadata are read
+        :param path: directory written by write_panel
+        :return: nothing
+        """
+
+        self.path = path
+
+        with open(os.path.join(path, METADATA_FILE)) as stored:
+            metadata = json.load(stored)
+        assert metadata['version'] <= FORMAT_VERSION
+
+        with open(os.path.join(path, INDEX_FILE)) as stored:
+            index = json.load(stored)
+
+        self.entities = _decode_labels(index['entities'])
+        self.times = _decode_labels(index['times'])
+        self.variables = _decode_labels(index['variables'])
+
+        self.shape = tuple(metadata['shape'])
+        self.dtype = np.dtype(metadata['dtype'])
+        self.files = dict(zip(self.variables.tolist(), metadata['files']))
+        self.has_mask = metadata['mask']
+
+        assert len(self.files) == self.shape[2]
+
+    def __repr__(self):
+        return '<PanelStore> %s\nDimensions: %d (entities) x %d (times) x %d (variables)\ndtype: %s' % (
+            (self.path,) + self.shape + (self.dtype,))
+
+    def __contains__(self, variable):
+        return variable in self.files
+
+    @property
+    def mask(self):
+        if not self.has_mask:
+            return None
+        return np.load(os.path.join(self.path, MASK_FILE))
+
+    def var(self, variable):
+        """
+        Memory-mapped view of one variable, nothing is read until it is used
+        :param variable: variable name
+        :return: read-only 2D memmap (entities * times)
+        """
+
+        values = np.load(os.path.join(self.path, self.files[variable]), mmap_mode='r')
+        assert values.shape == self.shape[:2]
+        return values
+
+    def select(self, variables):
+        """
+        Read some variables into a contiguous array, cells outside the mask are set to NaN
+        :param variables: list of variable names, in order
+        :return: 3D array (entities * times * len(variables))
+        """
+
+        selected = np.empty(self.shape[:2] + (len(variables),), dtype=self.dtype)
+        for position, variable in enumerate(variables):
+            selected[:, :, position] = self.var(variable)
+        mask = self.mask
+        if mask is not None:
+            selected[~mask] = np.nan
+        return selected
+
+    def load(self, variables=None):
+        """
+        Page some variables into an in-memory panel
+        :param variables: list of variable names, all variables if not supplied (duplicates are read once)
+        :return: PanelData
+        """
+
+        if variables is None:
+            variables = self.variables.tolist()
+        variables = list(dict.fromkeys(variables))
+
+        return PanelData(self.select(variables), self.entities, self.times, variables, self.mask, self.dtype)
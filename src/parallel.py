@@ -0,0 +1,165 @@
+"""
+Multiprocess estimation for panel data
+Entities are split across a process pool, every worker transforms its block of
+entities and returns partial cross-products, which are reduced at the end
+The input array is placed in shared memory once instead of being pickled to every worker
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from crossprod import CrossProducts, block_crossproducts, partial_out, robust_meat, transform_block
+from transforms import masked_sums
+
+BLOCKS_PER_JOB = 4  # more blocks than workers keeps the pool busy when entities differ in size
+
+
+def _attach(name, shape, dtype):
+    """
+    Attach to a shared memory block from a worker
+    :param name: name of the shared memory block
+    :param shape: shape of the shared array
+    :param dtype: dtype string of the shared array
+    :return: tuple of (SharedMemory, numpy array view)
+    """
+
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _block_task(args):
+    """
+    Worker task: transform one block of entities and accumulate it
+    :param args: tuple of (shared memory name, shape, dtype, first entity, last entity, transform, time totals, params)
+    time totals are the (time sums, time counts) of the whole panel for the twoway transform, or None;
+    if params is None, return the block's CrossProducts, otherwise its robust meat at params
+    :return: CrossProducts or k * k array
+    """
+
+    name, shape, dtype, start, stop, transform, time_totals, params = args
+
+    shm, data = _attach(name, shape, dtype)
+    try:
+        transformed = transform_block(data[start:stop], transform, time_totals)
+        if params is None:
+            result = CrossProducts.from_array(transformed)
+        else:
+            result = robust_meat(transformed, params)
+        del transformed, data
+    finally:
+        shm.close()
+
+    return result
+
+
+def _time_dummies_task(args):
+    """
+    Worker task: cross-products of one block of entities with its entity-demeaned time dummies, for exact time effects
+    :param args: tuple of (shared memory name, shape, dtype, first entity, last entity)
+    :return: CrossProducts of [y, X, time dummies]
+    """
+
+    name, shape, dtype, start, stop = args
+
+    shm, data = _attach(name, shape, dtype)
+    try:
+        result = block_crossproducts(data[start:stop], 'fe', True)
+        del data
+    finally:
+        shm.close()
+
+    return result
+
+
+def _time_sums_task(args):
+    """
+    Worker task: time sums and counts of the valid cells of one block of entities
+    :param args: tuple of (shared memory name, shape, dtype, first entity, last entity)
+    :return: tuple of (2D array (times * variables), 1D array of counts)
+    """
+
+    name, shape, dtype, start, stop = args
+
+    shm, data = _attach(name, shape, dtype)
+    try:
+        _, _, _, _, time_sums, time_counts = masked_sums(data[start:stop])
+        del data
+    finally:
+        shm.close()
+
+    return time_sums, time_counts
+
+
+def _entity_blocks(n_entities, n_jobs):
+    """
+    Split entities into contiguous blocks
+    :param n_entities: number of entities
+    :param n_jobs: number of workers
+    :return: list of (start, stop) tuples
+    """
+
+    edges = np.linspace(0, n_entities, min(n_entities, n_jobs * BLOCKS_PER_JOB) + 1).astype(int)
+    return [(start, stop) for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+
+
+def parallel_crossproducts(data, transform='fe', time_effects=False, n_jobs=2, cov_type='nonrobust', iterative=False):
+    """
+    Transform and accumulate a panel array across a process pool
+    :param data: 3D numpy array (entities * times * (1 + k)), depvar first
+    :param transform: 'fe' for entity demeaning or 'fd' for first differencing
+    :param time_effects: whether to include time effects (fe only), with the same one-shot twoway transform as
+    transforms.twoway_demean on the whole array: a first parallel pass gathers the time sums
+    :param n_jobs: number of worker processes
+    :param cov_type: 'nonrobust' or 'robust', robust runs a second parallel pass for the meat
+    :param iterative: whether the time effects are exact, as absorbed by alternating projections: the workers
+    accumulate entity-demeaned time dummies which are partialled out at the end (nonrobust only)
+    :return: tuple of (CrossProducts of [y, X], robust meat or None)
+    """
+
+    assert transform == 'fe' or not time_effects
+    assert not (time_effects and iterative and cov_type == 'robust')
+
+    k = data.shape[2] - 1
+    shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    try:
+        shared = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+        shared[...] = data
+        task = (shm.name, data.shape, data.dtype.str)
+        blocks = _entity_blocks(data.shape[0], n_jobs)
+
+        with ProcessPoolExecutor(n_jobs) as pool:
+            if time_effects and iterative:
+                dummies = CrossProducts(k + data.shape[1] - 1)
+                for partial in pool.map(_time_dummies_task, [task + (start, stop) for start, stop in blocks]):
+                    dummies.merge(partial)
+                del shared
+                return partial_out(dummies, k), None
+
+            time_totals = None
+            if time_effects:
+                time_sums = np.zeros((data.shape[1], k + 1))
+                time_counts = np.zeros(data.shape[1], dtype=np.int64)
+                for sums, counts in pool.map(_time_sums_task, [task + (start, stop) for start, stop in blocks]):
+                    time_sums += sums
+                    time_counts += counts
+                time_totals = (time_sums, time_counts)
+
+            products = CrossProducts(k)
+            for partial in pool.map(_block_task, [task + (start, stop, transform, time_totals, None) for start, stop in blocks]):
+                products.merge(partial)
+
+            meat = None
+            if cov_type == 'robust':
+                params, _ = products.solve()
+                meat = np.zeros((k, k))
+                for partial in pool.map(_block_task, [task + (start, stop, transform, time_totals, params) for start, stop in blocks]):
+                    meat += partial
+
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return products, meat
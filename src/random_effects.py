@@ -0,0 +1,309 @@
+"""
+Between and Random Effects for Panel Data
+Both come out of one pass over the data that collects the raw cross-products and the
+entity means of [y, X] on the common sample; the within (FE) cross-products, the between
+regression, the Swamy-Arora quasi-demeaning and the Hausman test are all derived from those
+"""
+
+import numpy as np
+
+from crossprod import CrossProducts, ols_results
+from instrument import NO_INSTRUMENTATION, get_instrumentation
+from panel_data import LongPanel, PanelData
+from panel_store import PanelStore
+from results import PanelResults
+from transforms import GroupIndex
+
+
+class EntityMoments(object):
+    def __init__(self, values, entity_codes, n_entities):
+        """
+        Collect the sufficient statistics of the FE, BE and RE estimators in one pass
+        Rows are centered on the grand mean first, so that the raw moments do not cancel
+        :param values: 2D array (rows * (1 + k)), depvar first, rows with NaN are skipped
+        :param entity_codes: 1D integer array of entity codes per row
+        :param n_entities: number of entities
+        :return: nothing
+        """
+
+        valid = np.isfinite(values).all(axis=1)
+        rows = values[valid].astype(np.float64, copy=False)
+        assert rows.shape[0] > 0
+
+        self.k = rows.shape[1] - 1
+        self.nobs = rows.shape[0]
+        self.grand = rows.mean(axis=0)
+
+        centered = rows - self.grand
+        group = GroupIndex(entity_codes[valid], n_entities)
+        observed = group.counts > 0
+
+        self.counts = group.counts[observed].astype(np.float64)  # T_i
+        self.means = group.means(centered)[observed]  # centered entity means of [y, X]
+        self.raw = CrossProducts.from_array(centered).zz  # sum of z z' over all rows
+
+    @classmethod
+    def from_panel(cls, panel, variables):
+        """
+        Collect the moments of some variables of a panel
+        :param panel: PanelData or LongPanel
+        :param variables: list of variable names, depvar first
+        :return: EntityMoments
+        """
+
+        values = panel.select(variables)
+        if type(panel) is LongPanel:
+            return cls(values, panel.entity_codes, len(panel.entities))
+
+        n_entities, n_times = values.shape[:2]
+        return cls(values.reshape(-1, values.shape[2]), np.repeat(np.arange(n_entities), n_times), n_entities)
+
+    @property
+    def n_entities(self):
+        return self.counts.shape[0]
+
+    def quasi_crossproducts(self, theta):
+        """
+        Cross-products of [y, X] after subtracting theta_i times the entity means
+        theta = 1 gives the within transform, theta = 0 the pooled (centered) data
+        :param theta: scalar or 1D array of theta_i per entity
+        :return: 2D array ((1 + k) * (1 + k))
+        """
+
+        weight = self.counts * (2 * theta - theta ** 2)
+        return self.raw - np.dot(self.means.T, self.means * weight[:, np.newaxis])
+
+    def within(self, depvar, indvars):
+        """
+        Fixed effects (within) estimates, with the residual degrees of freedom net of the entity effects
+        :param depvar: name of the dependent variable
+        :param indvars: names of the independent variables
+        :return: PanelResults
+        """
+
+        products = CrossProducts(self.k)
+        products.zz = self.quasi_crossproducts(1.)
+        products.nobs = self.nobs
+
+        params, xtx_inv = products.solve()
+        ssr = products.yty - np.dot(params, products.xty)
+        df_resid = self.nobs - self.n_entities - self.k
+
+        return PanelResults(params, xtx_inv * ssr / df_resid, self.nobs, df_resid, ssr, products.yty, depvar, indvars)
+
+    def between(self, depvar, indvars):
+        """
+        Between estimates: OLS of the entity means of y on a constant and the entity means of X
+        :param depvar: name of the dependent variable
+        :param indvars: names of the independent variables
+        :return: PanelResults, the first parameter is the constant
+        """
+
+        means = self.means + self.grand
+        design = np.column_stack([means[:, :1], np.ones(self.n_entities), means[:, 1:]])
+        return ols_results(CrossProducts.from_array(design), depvar, ['const'] + list(indvars))
+
+    def swamy_arora(self, within, between):
+        """
+        Variance components and quasi-demeaning weights of Swamy and Arora
+        :param within: PanelResults of the within estimator
+        :param between: PanelResults of the between estimator
+        :return: tuple of (idiosyncratic variance, entity effect variance, 1D array of theta_i)
+        """
+
+        sigma2_e = within.ssr / within.df_resid
+        sigma2_b = between.ssr / between.df_resid
+        harmonic = self.n_entities / (1. / self.counts).sum()
+        sigma2_u = max(sigma2_b - sigma2_e / harmonic, 0.)
+
+        theta = 1. - np.sqrt(sigma2_e / (self.counts * sigma2_u + sigma2_e))
+        return sigma2_e, sigma2_u, theta
+
+    def random_effects(self, depvar, indvars, theta):
+        """
+        GLS random effects estimates: OLS of the quasi-demeaned data on a quasi-demeaned constant and X
+        :param depvar: name of the dependent variable
+        :param indvars: names of the independent variables
+        :param theta: 1D array of theta_i per entity
+        :return: PanelResults, the first parameter is the constant
+        """
+
+        k = self.k
+        kept = self.counts * (1. - theta) ** 2
+        quasi = self.quasi_crossproducts(theta)
+        constant = np.dot(kept, self.means)  # cross-products of the (1 - theta_i) constant with [y, X]
+
+        # [y, const, X] in the centered units
+        positions = [0] + list(range(2, k + 2))
+        zz = np.empty((k + 2, k + 2))
+        zz[np.ix_(positions, positions)] = quasi
+        zz[1, 1] = kept.sum()
+        zz[1, positions] = constant
+        zz[positions, 1] = constant
+
+        products = CrossProducts(k + 1)
+        products.zz = zz
+        products.nobs = self.nobs
+        results = ols_results(products, depvar, ['const'] + list(indvars))
+
+        # back from centered units: const = const' + mean(y) - b' mean(X)
+        shift = np.eye(k + 1)
+        shift[0, 1:] = -self.grand[1:]
+        results.params = np.dot(shift, results.params)
+        results.params[0] += self.grand[0]
+        results.cov_params = np.dot(np.dot(shift, results.cov_params), shift.T)
+        return results
+
+
+def hausman(within, random, indvars=None):
+    """
+    Hausman test of random against fixed effects on the common slope coefficients
+    :param within: PanelResults of the within estimator
+    :param random: PanelResults of the random effects estimator
+    :param indvars: names of the coefficients to compare, all slopes of the within estimator if not supplied
+    :return: tuple of (chi2 statistic, degrees of freedom, p-value)
+    """
+
+    from scipy import stats
+
+    if indvars is None:
+        indvars = within.indvars
+
+    fe_positions = [within.indvars.index(name) for name in indvars]
+    re_positions = [random.indvars.index(name) for name in indvars]
+
+    difference = within.params[fe_positions] - random.params[re_positions]
+    variance = within.cov_params[np.ix_(fe_positions, fe_positions)] - random.cov_params[np.ix_(re_positions, re_positions)]
+
+    statistic = float(np.dot(np.dot(difference, np.linalg.pinv(variance)), difference))
+    df = int(np.linalg.matrix_rank(variance))
+    return statistic, df, float(stats.chi2.sf(statistic, df))
+
+
+class PanelMeansEstimator(object):
+    def __init__(self, panel, y, x, instrument=None):
+        """
+        Common setup of the estimators built on entity means
+        :param panel: PanelData, LongPanel or PanelStore (only the variables of the model are read from disk)
+        :param y: name of the dependent variable
+        :param x: name of the independent variables
+        :param instrument: True or an Instrumentation to record time, memory and copies per phase, off by default
+        :return: nothing
+        """
+
+        assert type(panel) in (PanelData, LongPanel, PanelStore)
+
+        if type(x) is str:
+            x = [x]
+
+        if type(panel) is PanelStore:
+            # page in only the variables the model uses
+            panel = panel.load([y] + list(x))
+
+        assert y in panel
+
+        for indvar in x:
+            assert indvar in panel
+            assert indvar != y
+
+        self.panel = panel
+        self.depvar = y
+        self.indvars = list(x)
+
+        self.instrument = get_instrumentation(instrument)
+
+        self.moments = None
+        self.result = None
+
+    def _moments(self):
+        """
+        Collect the entity moments once, later estimates reuse them
+        :return: EntityMoments
+        """
+
+        if self.moments is None:
+            with self.instrument.phase('moments'):
+                self.moments = EntityMoments.from_panel(self.panel, [self.depvar] + self.indvars)
+        return self.moments
+
+    def _finish(self, results, first_record, verbose):
+        if self.instrument is not NO_INSTRUMENTATION:
+            results.phases = self.instrument.records[first_record:]
+
+        if verbose:
+            print(results.summary())
+
+        self.result = results
+        return results
+
+
+class BetweenEstimator(PanelMeansEstimator):
+    def estimate(self, verbose=False):
+        """
+        Estimate the between model, OLS on the entity means with a constant
+        :param verbose: whether to print the summary
+        :return: results
+        """
+
+        first_record = len(self.instrument.records)  # phases of this call only
+        moments = self._moments()
+        with self.instrument.phase('solve'):
+            results = moments.between(self.depvar, self.indvars)
+        return self._finish(results, first_record, verbose)
+
+
+class RandomEffects(PanelMeansEstimator):
+    def __init__(self, panel, y, x, instrument=None):
+        """
+        Initialize the Random Effects class (Swamy-Arora variance components)
+        :param panel: PanelData, LongPanel or PanelStore (only the variables of the model are read from disk)
+        :param y: name of the dependent variable
+        :param x: name of the independent variables
+        :param instrument: True or an Instrumentation to record time, memory and copies per phase, off by default
+        :return: nothing
+        """
+
+        super(RandomEffects, self).__init__(panel, y, x, instrument)
+
+        self.within = None
+        self.between = None
+        self.sigma2_e = None
+        self.sigma2_u = None
+        self.theta = None
+
+    def estimate(self, verbose=False):
+        """
+        Estimate the within and between models, the variance components and the GLS random effects model,
+        all from the same entity moments
+        :param verbose: whether to print the summary and the variance components
+        :return: results
+        """
+
+        first_record = len(self.instrument.records)  # phases of this call only
+        moments = self._moments()
+        with self.instrument.phase('solve'):
+            self.within = moments.within(self.depvar, self.indvars)
+            self.between = moments.between(self.depvar, self.indvars)
+            self.sigma2_e, self.sigma2_u, self.theta = moments.swamy_arora(self.within, self.between)
+            results = moments.random_effects(self.depvar, self.indvars, self.theta)
+
+        self._finish(results, first_record, verbose)
+        if verbose:
+            print('sigma_e: %.4g    sigma_u: %.4g    theta (median): %.4f' % (
+                np.sqrt(self.sigma2_e), np.sqrt(self.sigma2_u), np.median(self.theta)))
+        return results
+
+    def hausman(self, verbose=False):
+        """
+        Hausman test of these random effects against the fixed effects of the same sample
+        :param verbose: whether to print the test
+        :return: tuple of (chi2 statistic, degrees of freedom, p-value)
+        """
+
+        if self.result is None:
+            self.estimate()
+
+        statistic, df, pvalue = hausman(self.within, self.result, self.indvars)
+        if verbose:
+            print('Hausman chi2(%d) = %.4f    Prob > chi2 = %.4f' % (df, statistic, pvalue))
+        return statistic, df, pvalue
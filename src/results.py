@@ -0,0 +1,76 @@
+"""
+Results of a panel regression estimated from sufficient statistics
+A slim slotted object, the summary table (and scipy for its p-values) is only built on request
+"""
+
+import numpy as np
+
+
+class PanelResults(object):
+    __slots__ = ('params', 'cov_params', 'nobs', 'df_resid', 'ssr', 'tss', 'depvar', 'indvars', 'cov_type', 'phases')
+
+    def __init__(self, params, cov, nobs, df_resid, ssr, tss, depvar, indvars, cov_type='nonrobust'):
+        """
+        Initialize the results object
+        :param params: estimated coefficients
+        :param cov: covariance matrix of the coefficients
+        :param nobs: number of observations used
+        :param df_resid: residual degrees of freedom
+        :param ssr: sum of squared residuals
+        :param tss: (uncentered) total sum of squares of the transformed dependent variable
+        :param depvar: name of the dependent variable
+        :param indvars: names of the independent variables
+        :param cov_type: type of the covariance estimator
+        :return: nothing
+        """
+
+        self.params = np.asarray(params)
+        self.cov_params = np.asarray(cov)
+        self.nobs = nobs
+        self.df_resid = df_resid
+        self.ssr = ssr
+        self.tss = tss
+        self.depvar = depvar
+        self.indvars = list(indvars)
+        self.cov_type = cov_type
+        self.phases = None  # per-phase records when the estimator is instrumented
+
+    @property
+    def bse(self):
+        return np.sqrt(np.diag(self.cov_params))
+
+    @property
+    def tvalues(self):
+        return self.params / self.bse
+
+    @property
+    def pvalues(self):
+        from scipy import stats
+        return 2 * stats.t.sf(np.abs(self.tvalues), self.df_resid)
+
+    @property
+    def rsquared(self):
+        return 1. - self.ssr / self.tss if self.tss > 0 else np.nan
+
+    def summary(self):
+        """
+        Text table of the estimates
+        :return: string
+        """
+
+        width = max([len(str(name)) for name in self.indvars] + [10])
+        lines = [
+            'Dep. Variable: %s' % self.depvar,
+            'No. Observations: %d    Df Residuals: %d    R-squared: %.4f' % (self.nobs, self.df_resid, self.rsquared),
+            'Covariance Type: %s' % self.cov_type,
+            '=' * (width + 48),
+            '%s %11s %11s %11s %11s' % (' ' * width, 'coef', 'std err', 't', 'P>|t|'),
+            '-' * (width + 48),
+        ]
+        for name, coef, se, t, p in zip(self.indvars, self.params, self.bse, self.tvalues, self.pvalues):
+            lines.append('%s %11.4g %11.4g %11.3f %11.3f' % (str(name).ljust(width), coef, se, t, p))
+        lines.append('=' * (width + 48))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.summary()
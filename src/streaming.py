@@ -0,0 +1,227 @@
+"""
+Out-of-core estimation for panels larger than memory
+Read entity blocks from disk one chunk at a time, transform each block within
+its entities and fold it into running cross-product accumulators
+
+Supported sources:
+.npy shards: 3D arrays (entities * times * variables), memory mapped
+.csv / .parquet files: long format with an entity column, a time column and one column per variable,
+rows must be grouped by entity
+in-memory 3D numpy arrays or long pandas dataframes
+"""
+
+import numpy as np
+import pandas as pd
+
+from crossprod import CrossProducts, block_crossproducts, ols_results, partial_out, robust_meat, transform_block
+from transforms import masked_sums, valid_mask
+
+
+def _long_frames(path, chunksize, columns=None):
+    """
+    Read a long-format file in chunks of rows
+    :param path: path to a .csv or .parquet file
+    :param chunksize: number of rows per chunk
+    :param columns: names of the columns to read, all if not supplied
+    :return: generator of pandas dataframes
+    """
+
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        for frame in pd.read_csv(path, chunksize=chunksize, usecols=columns):
+            yield frame
+
+
+def collect_times(source, time_col='time', chunksize=100000):
+    """
+    First pass over the long-format parts of a source for all of its time periods
+    Only the time column is read from files
+    :param source: a path, a 3D numpy array, a long pandas dataframe, or a list of those
+    :param time_col: name of the time column in long-format sources
+    :param chunksize: number of rows read at a time from long-format files
+    :return: sorted pandas Index of the periods
+    """
+
+    if type(source) not in (list, tuple):
+        source = [source]
+
+    times = pd.Index([])
+    for part in source:
+        if isinstance(part, np.ndarray) or (type(part) is str and part.endswith('.npy')):
+            continue
+        frames = [part] if type(part) is pd.DataFrame else _long_frames(part, chunksize, [time_col])
+        for frame in frames:
+            times = times.union(pd.Index(frame[time_col].unique()))
+
+    return times.sort_values()
+
+
+def _whole_entities(frames, entity_col):
+    """
+    Regroup chunks of rows so that no entity is split between two chunks
+    The rows of the last entity in every chunk are carried over to the next one
+    :param frames: iterable of long pandas dataframes, rows grouped by entity
+    :param entity_col: name of the entity column
+    :return: generator of long pandas dataframes made of whole entities
+    """
+
+    carry = None
+    for frame in frames:
+        if carry is not None:
+            frame = pd.concat([carry, frame], ignore_index=True)
+        if len(frame) == 0:
+            continue
+
+        entities = frame[entity_col].values
+        last = np.flatnonzero(entities != entities[-1])
+        split = last[-1] + 1 if len(last) else 0
+
+        carry = frame.iloc[split:]
+        if split > 0:
+            yield frame.iloc[:split]
+
+    if carry is not None and len(carry) > 0:
+        yield carry
+
+
+def long_to_block(frame, variables, entity_col='entity', time_col='time', times=None):
+    """
+    Turn a long dataframe of whole entities into a 3D block
+    :param frame: long pandas dataframe
+    :param variables: columns to put into the block, in order
+    :param entity_col: name of the entity column
+    :param time_col: name of the time column
+    :param times: all time periods of the panel, so that every chunk has the same periods
+    :return: 3D numpy array (entities * times * variables), NaN in missing cells
+    """
+
+    assert times is not None, 'long-format chunks need all time periods of the panel, see collect_times'
+
+    entity_codes, entities = pd.factorize(frame[entity_col].values)
+    time_codes = pd.Index(times).get_indexer(frame[time_col].values)
+    assert (time_codes >= 0).all(), 'a chunk has periods that are not in times'
+
+    block = np.full((len(entities), len(times), len(variables)), np.nan)
+    block[entity_codes, time_codes] = frame[list(variables)].values.astype(np.float64)
+    return block
+
+
+def read_chunks(source, variables, entity_col='entity', time_col='time', times=None, chunksize=100000, columns=None):
+    """
+    Read a panel as blocks of whole entities
+    :param source: a path, a 3D numpy array, a long pandas dataframe, or a list of those
+    :param variables: names of the variables to read, in order
+    :param entity_col: name of the entity column in long-format sources
+    :param time_col: name of the time column in long-format sources
+    :param times: all time periods of long-format sources, to align periods across chunks; collected in a first pass
+    over the time column if not supplied
+    :param chunksize: number of rows read at a time from long-format files
+    :param columns: names of the variables along the last axis of 3D sources (.npy shards and arrays)
+    :return: generator of 3D numpy arrays (entities * times * variables)
+    """
+
+    if type(source) not in (list, tuple):
+        source = [source]
+
+    if times is None:
+        times = collect_times(source, time_col, chunksize)
+
+    for part in source:
+        if isinstance(part, np.ndarray) or (type(part) is str and part.endswith('.npy')):
+            if type(part) is str:
+                part = np.load(part, mmap_mode='r')
+            assert part.ndim == 3
+            assert columns is not None
+            columns = list(columns)
+            positions = [columns.index(variable) for variable in variables]
+            yield np.asarray(part[:, :, positions], dtype=np.float64)
+        else:
+            frames = [part] if type(part) is pd.DataFrame else _long_frames(part, chunksize)
+            for frame in _whole_entities(frames, entity_col):
+                yield long_to_block(frame, variables, entity_col, time_col, times)
+
+
+def stream_estimate(source, y, x, transform='fe', time=False, cov_type='nonrobust', iterative=False, **reader_options):
+    """
+    Estimate FE or FD from a panel read chunk by chunk
+    Peak memory is one chunk plus the (k + 1) * (k + 1) accumulators
+    :param source: anything read_chunks accepts
+    :param y: name of the dependent variable
+    :param x: name(s) of the independent variables
+    :param transform: 'fe' for entity fixed effects or 'fd' for first differences
+    :param time: whether to include time effects (fe only); by default with the one-shot twoway transform of
+    FixedEffects(time=True), exact for balanced panels only, whose time sums take a first pass over the source
+    :param cov_type: 'nonrobust' or 'robust' (HC1), robust makes a second pass over the source
+    :param iterative: whether to partial out exact time effects (as time dummies) instead, the estimates of
+    FixedEffects(time=True, iterative=True), nonrobust only
+    :param reader_options: keyword arguments of read_chunks
+    :return: PanelResults
+    """
+
+    if type(x) is str:
+        x = [x]
+    variables = [y] + list(x)
+
+    assert cov_type in ('nonrobust', 'robust')
+    assert transform == 'fe' or not time
+    assert not (time and iterative and cov_type == 'robust')
+
+    if reader_options.get('times') is None:
+        # one pass for the periods, shared by every later pass
+        reader_options['times'] = collect_times(source, reader_options.get('time_col', 'time'),
+                                                reader_options.get('chunksize', 100000))
+
+    time_totals = None
+    if time and not iterative:
+        # time sums of the whole panel, every block is then demeaned as in twoway_demean
+        time_sums, time_counts = 0., 0
+        for block in read_chunks(source, variables, **reader_options):
+            _, _, _, _, sums, counts = masked_sums(block)
+            time_sums, time_counts = time_sums + sums, time_counts + counts
+        time_totals = (time_sums, time_counts)
+
+    products = None
+    entities = 0
+    periods = None
+    for block in read_chunks(source, variables, **reader_options):
+        if transform == 'fe':
+            # observed entities and periods, their effects are taken off the degrees of freedom
+            observed = valid_mask(block)
+            entities += int(observed.any(axis=1).sum())
+            if time:
+                periods = observed.any(axis=0) if periods is None else periods | observed.any(axis=0)
+
+        if time and iterative:
+            partial = block_crossproducts(block, transform, True)
+        else:
+            partial = CrossProducts.from_array(transform_block(block, transform, time_totals))
+
+        if products is None:
+            products = partial
+        else:
+            assert partial.k == products.k, 'all chunks must have the same periods to partial out time effects'
+            products.merge(partial)
+
+    assert products is not None
+
+    if time and iterative:
+        products = partial_out(products, len(x))
+
+    meat = None
+    if cov_type == 'robust':
+        # the source is read again, generators can not be used here
+        params, _ = products.solve()
+        meat = np.zeros((len(x), len(x)))
+        for block in read_chunks(source, variables, **reader_options):
+            meat += robust_meat(transform_block(block, transform, time_totals), params)
+
+    absorbed = None
+    if transform == 'fe':
+        absorbed = {'entity': entities}
+        if time:
+            absorbed['time'] = int(periods.sum()) - 1
+
+    return ols_results(products, y, x, cov_type, meat=meat, absorbed=absorbed)
@@ -1,19 +1,222 @@
-import cPickle as pickle
+import os
+import numpy as np
 from first_diff import FirstDiff
 from fixed_effects import FixedEffects
-import pandas as pd
+from incremental import IncrementalFirstDiff, IncrementalFixedEffects, rolling
+from legacy_panel import read_legacy_panel
+from panel_data import PanelData
+from panel_store import PanelStore, write_panel
 
 data_file = '../data/nulled_panel'
+store_dir = '../data/nulled_panel_store'
+
+depvar = 'SP.DYN.LE00.IN'
+indvars = ['SH.XPD.PRIV.ZS', 'SH.XPD.PUBL.ZS', 'SH.XPD.PUBL.GX.ZS', 'SH.XPD.PUBL', 'SH.XPD.PCAP.PP.KD', 'SH.XPD.TOTL.ZS', 'SH.MED.BEDS.ZS']
+
+
+def check_float32(panel, model, backend='crossprod', **options):
+    """
+    Fit a model in float64 and float32 and check that they agree:
+    coefficients within 1e-3 standard errors, standard errors within a relative 1e-4
+    :param panel: PanelData or PanelStore
+    :param model: FixedEffects or FirstDiff
+    :param backend: estimation backend
+    :param options: keyword arguments of the model
+    :return: nothing
+    """
+
+    results = []
+    for dtype in (np.float64, np.float32):
+        estimator = model(panel, depvar, indvars, dtype=dtype, **options)
+        estimator.estimate(backend)
+        assert estimator.data.dtype == dtype
+        results.append(estimator.result)
+
+    full, reduced = results
+    params_error = np.max(np.abs(np.asarray(reduced.params) - np.asarray(full.params)) / np.asarray(full.bse))
+    bse_error = np.max(np.abs(np.asarray(reduced.bse) / np.asarray(full.bse) - 1))
+    print('float32 %s %s %s: params %.2e se, bse %.2e' % (model.__name__, backend, options, params_error, bse_error))
+    assert params_error < 1e-3
+    assert bse_error < 1e-4
+
+
+def check_bootstrap(panel, model, y=depvar, x=indvars, **options):
+    """
+    Check that the bootstrap is centered on the same coefficients as the estimate
+    :param panel: PanelData or PanelStore
+    :param model: FixedEffects or FirstDiff
+    :param y: name of the dependent variable
+    :param x: names of the independent variables
+    :param options: keyword arguments of the model
+    :return: nothing
+    """
+
+    estimator = model(panel, y, x, **options)
+    estimated = estimator.estimate()
+    clustered = estimator.estimate(cov_type='cluster')
+    for method in ('wild', 'pairs', 'block'):
+        bootstrapped = estimator.bootstrap(method, reps=49, seed=0)
+        error = np.max(np.abs(bootstrapped.params - estimated.params) / np.abs(estimated.bse))
+        print('bootstrap %s %s %s: params %.2e se' % (model.__name__, method, options, error))
+        assert error < 1e-8
+        assert bootstrapped.df_resid == estimated.df_resid
+
+        # the same seed gives the same replicates in any number of processes
+        parallel = estimator.bootstrap(method, reps=49, seed=0, n_jobs=2)
+        assert np.array_equal(parallel.replicates, bootstrapped.replicates)
+
+    # entity resampling and clustering by entity measure the same sampling variance
+    ratio = np.asarray(estimator.bootstrap('pairs', reps=199, seed=0).bse) / np.asarray(clustered.bse)
+    print('bootstrap %s pairs %s: se / clustered se %.2f .. %.2f' % (model.__name__, options, ratio.min(), ratio.max()))
+    assert (ratio > 0.25).all() and (ratio < 4).all()
+
+
+def check_parallel(panel, **options):
+    """
+    Check that splitting entities across a process pool gives the serial estimate
+    :param panel: PanelData or PanelStore
+    :param options: keyword arguments of FixedEffects
+    :return: nothing
+    """
+
+    estimator = FixedEffects(panel, depvar, indvars, **options)
+    serial = estimator.estimate()
+    parallel = estimator.estimate(n_jobs=2)
+    params_error = np.max(np.abs(parallel.params - serial.params) / np.abs(serial.bse))
+    bse_error = np.max(np.abs(parallel.bse / serial.bse - 1))
+    print('parallel %s: params %.2e se, bse %.2e' % (options, params_error, bse_error))
+    assert params_error < 1e-8
+    assert bse_error < 1e-8
+
+
+def check_incremental_slices(panel):
+    """
+    Check that the incremental estimators fed whole time slices of the panel, as passed to
+    PanelBuilder.frames_by_time, match the ones started from the panel
+    :param panel: PanelData or PanelStore
+    :return: nothing
+    """
+
+    variables = panel.variables.tolist()
+    data = panel.select(variables)
+    for model in (IncrementalFixedEffects, IncrementalFirstDiff):
+        estimator = model(depvar, indvars, panel.entities, variables)
+        for position, time in enumerate(panel.times.tolist()):
+            estimator.update(data[:, position, :], time)
+        expected = model.from_panel(panel, depvar, indvars).estimate()
+        error = np.max(np.abs(estimator.estimate().params - expected.params))
+        print('incremental %s slices: params %.2e' % (model.__name__, error))
+        assert error == 0
+
+
+def check_rolling_stops_varying(n_entities=30, n_times=12, last_change=3, window=4, seed=0):
+    """
+    Check that rolling windows in which a regressor no longer varies are left out
+    :param n_entities: number of entities
+    :param n_times: number of periods
+    :param last_change: last period in which the regressor changes
+    :param window: number of periods per window
+    :param seed: random seed
+    :return: nothing
+    """
+
+    rng = np.random.RandomState(seed)
+    values = rng.normal(size=(n_entities, n_times, 3))
+    values[:, last_change + 1:, 2] = values[:, last_change:last_change + 1, 2]
+    panel = PanelData(values, np.arange(n_entities), np.arange(n_times), ['y', 'x0', 'x1'])
+
+    # the last window in which x1 varies holds the periods last_change - 1 and last_change
+    last_window = last_change + window - 2
+    for model in ('fe', 'fd'):
+        estimated = rolling(panel, 'y', ['x0', 'x1'], window, model).index.tolist()
+        print('rolling %s, x1 constant after %d: windows %s' % (model, last_change, estimated))
+        assert estimated == list(range(window - 1, last_window + 1))
+
+
+def constant_entities_panel(n_entities=30, n_times=8, n_constant=10, seed=0):
+    """
+    Linear probability panel where some entities never change their outcome
+    :param n_entities: number of entities
+    :param n_times: number of periods
+    :param n_constant: number of entities with y = 1 in every period
+    :param seed: random seed
+    :return: PanelData with variables y, x
+    """
+
+    rng = np.random.RandomState(seed)
+    x = rng.normal(size=(n_entities, n_times))
+    y = (rng.uniform(size=(n_entities, n_times)) < 0.5 + 0.2 * x).astype(np.float64)
+    y[:n_constant] = 1.
+    return PanelData(np.stack([y, x], axis=2), np.arange(n_entities), np.arange(n_times), ['y', 'x'])
+
+
+def check_nested_effects(n_entities=60, n_times=12, n_industries=6, seed=0):
+    """
+    Check the residual degrees of freedom with an industry * year effect, in which the entity and year effects are
+    nested, against the rank of the dense dummy matrix
+    :param n_entities: number of entities
+    :param n_times: number of periods
+    :param n_industries: number of industries, every entity belongs to one
+    :param seed: random seed
+    :return: nothing
+    """
+
+    rng = np.random.RandomState(seed)
+    values = rng.normal(size=(n_entities, n_times, 3))
+    values[rng.uniform(size=(n_entities, n_times)) < 0.2] = np.nan
+    industry = rng.randint(n_industries, size=n_entities)
+    industry_year = industry[:, np.newaxis] * n_times + np.arange(n_times)
+
+    panel = PanelData(values, np.arange(n_entities), np.arange(n_times), ['y', 'x0', 'x1'])
+    results = FixedEffects(panel, 'y', ['x0', 'x1'], time=True, absorb=[industry_year]).estimate()
+
+    entity_codes, time_codes = np.nonzero(np.isfinite(values).all(axis=2))
+    dummies = np.hstack([np.eye(n_entities)[entity_codes], np.eye(n_times)[time_codes],
+                         np.eye(n_industries * n_times)[industry_year[entity_codes, time_codes]]])
+    expected = entity_codes.shape[0] - 2 - np.linalg.matrix_rank(dummies)
+    print('nested effects: df_resid %d, expected %d' % (results.df_resid, expected))
+    assert results.df_resid == expected
 
 
 if __name__ == '__main__':
-    panel = pickle.load(open(data_file, 'rb'))
+    if not os.path.isdir(store_dir):
+        # one-time conversion of the legacy pandas Panel pickle, see legacy_panel.py
+        write_panel(read_legacy_panel(data_file), store_dir)
+
+    panel = PanelStore(store_dir)  # only the variables of each model are read from disk
     print(panel)
     fd = FirstDiff(panel, 'SP.DYN.LE00.IN', ['SH.XPD.PRIV.ZS', 'SH.XPD.PUBL.ZS', 'SH.XPD.PUBL.GX.ZS', 'SH.XPD.PUBL', 'SH.XPD.PCAP.PP.KD', 'SH.XPD.TOTL.ZS', 'SH.MED.BEDS.ZS'])
-    fd.estimate()
+    fd.estimate(verbose=True)
 
     fe = FixedEffects(panel, 'SP.DYN.LE00.IN', ['SH.XPD.PRIV.ZS', 'SH.XPD.PUBL.ZS', 'SH.XPD.PUBL.GX.ZS', 'SH.XPD.PUBL', 'SH.XPD.PCAP.PP.KD', 'SH.XPD.TOTL.ZS', 'SH.MED.BEDS.ZS'])
-    fe.estimate()
+    fe.estimate(verbose=True)
 
     fe2 = FixedEffects(panel, 'SP.DYN.LE00.IN', ['SH.XPD.PRIV.ZS', 'SH.XPD.PUBL.ZS', 'SH.XPD.PUBL.GX.ZS', 'SH.XPD.PUBL', 'SH.XPD.PCAP.PP.KD', 'SH.XPD.TOTL.ZS', 'SH.MED.BEDS.ZS'], True)
-    fe2.estimate()
\ No newline at end of file
+    fe2.estimate(verbose=True)
+
+    # reduced precision must agree with float64
+    for backend in ('crossprod', 'statsmodels'):
+        check_float32(panel, FirstDiff, backend)
+        check_float32(panel, FixedEffects, backend)
+        check_float32(panel, FixedEffects, backend, time=True)
+    check_float32(panel, FixedEffects, time=True, iterative=True)
+    check_float32(PanelData(panel.load().values, panel.entities, panel.times, panel.variables, dtype=np.float32), FixedEffects)
+
+    # a process pool runs the same transforms as one process
+    check_parallel(panel)
+    check_parallel(panel, time=True)
+    check_parallel(panel, time=True, iterative=True)
+
+    # the incremental estimators take whole builder slices
+    check_incremental_slices(panel)
+
+    # windows where a regressor stopped varying are not identified
+    check_rolling_stops_varying()
+
+    # the bootstrap solves on the same cross-products as the estimate
+    check_bootstrap(panel, FixedEffects)
+    check_bootstrap(panel, FirstDiff)
+    check_bootstrap(constant_entities_panel(), FixedEffects, 'y', ['x'])
+
+    # absorbed effects nested in each other only count once
+    check_nested_effects()
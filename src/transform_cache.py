@@ -0,0 +1,218 @@
+"""
+LRU cache of transformed panel variables, shared across estimator instances
+Entries are keyed by a fingerprint of each variable (the identity of its panel and a content
+key of the variable alone), the transform (entity demeaning, twoway demeaning or first differencing),
+the estimation sample and the dtype, and evicted least-recently-used beyond a memory budget
+"""
+
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from panel_data import PanelData
+from panel_store import PanelStore
+from transforms import entity_demean, first_difference, twoway_demean, valid_mask
+
+
+def fingerprint(panel, variables):
+    """
+    Fingerprints of some variables of a panel, each one is the panel identity and a content key of the variable
+    A PanelStore is identified by its path and a variable by the modification time and size of its file, so the
+    panels it loads share entries whatever variables they hold. A PanelData is identified by its shape, dtype and
+    labels and a variable by a hash of its values, both computed on first use and kept on the panel: edit a panel in
+    place only before its first cached fit
+    :param panel: PanelData or PanelStore
+    :param variables: list of variable names
+    :return: list of tuples, one per variable
+    """
+
+    if type(panel) is PanelStore:
+        identity = ('store', os.path.abspath(panel.path), panel.shape, str(panel.dtype))
+        keys = []
+        for variable in variables:
+            stat = os.stat(os.path.join(panel.path, panel.files[variable]))
+            keys.append((identity, variable, stat.st_mtime_ns, stat.st_size))
+        return keys
+
+    assert type(panel) is PanelData
+
+    memo = panel._keys
+    if None not in memo:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((panel.shape, str(panel.dtype))).encode())
+        for labels in (panel.entities, panel.times):
+            digest.update(repr(labels.tolist()).encode())
+        if panel.mask is not None:
+            digest.update(np.packbits(panel.mask).tobytes())
+        memo[None] = ('panel', digest.hexdigest())
+
+    keys = []
+    for variable in variables:
+        if variable not in memo:
+            values = np.ascontiguousarray(panel.var(variable))  # one variable, not the whole buffer
+            memo[variable] = hashlib.blake2b(values.data, digest_size=16).hexdigest()
+        keys.append((memo[None], variable, memo[variable]))
+    return keys
+
+
+def _sample_key(mask):
+    """
+    Short key of an estimation sample
+    :param mask: 2D boolean array of valid cells
+    :return: hex digest string
+    """
+
+    return hashlib.blake2b(np.packbits(mask).tobytes(), digest_size=16).hexdigest()
+
+
+class TransformCache(object):
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        """
+        Initialize an empty cache
+        :param max_bytes: memory budget for the cached arrays
+        :return: nothing
+        """
+
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()  # least recently used first
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '<TransformCache> %d entries, %d of %d bytes, %d hits, %d misses, %d evictions' % (
+            len(self._entries), self.nbytes, self.max_bytes, self.hits, self.misses, self.evictions)
+
+    def stats(self):
+        """
+        Hit/miss statistics of the cache
+        :return: dict
+        """
+
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.,
+            'entries': len(self._entries),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+        }
+
+    def get(self, key):
+        """
+        Look up an entry and mark it as recently used
+        :param key: hashable key
+        :return: cached array or None
+        """
+
+        array = self._entries.get(key)
+        if array is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return array
+
+    def put(self, key, array):
+        """
+        Store an entry, evicting least recently used entries beyond the memory budget
+        Arrays larger than the whole budget are not stored
+        :param key: hashable key
+        :param array: numpy array, stored read-only
+        :return: nothing
+        """
+
+        if array.nbytes > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key).nbytes
+
+        array.flags.writeable = False
+        self._entries[key] = array
+        self.nbytes += array.nbytes
+        self.resize(self.max_bytes)
+
+    def resize(self, max_bytes):
+        """
+        Change the memory budget and evict entries down to it
+        :param max_bytes: new memory budget
+        :return: nothing
+        """
+
+        self.max_bytes = max_bytes
+        while self.nbytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Drop all entries and reset the statistics
+        :return: nothing
+        """
+
+        self._entries.clear()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def transform(self, variable_keys, data, kind, lag=1, order=1):
+        """
+        Transform the columns of data, reusing the cached ones
+        :param variable_keys: fingerprints of the variables along the last axis of data, see fingerprint
+        :param data: 3D array (entities * times * variables)
+        :param kind: 'entity' or 'twoway' demeaning on the common sample of all variables,
+        or 'fd' for first differences of every variable on its own
+        :param lag: number of periods to difference over ('fd' only)
+        :param order: number of times to difference ('fd' only)
+        :return: 3D array of transformed data
+        """
+
+        assert kind in ('entity', 'twoway', 'fd')
+
+        if kind == 'fd':
+            mask, sample = None, (lag, order)
+            shape = (data.shape[0], data.shape[1] - lag * order, data.shape[2])
+        else:
+            mask = valid_mask(data)
+            sample = _sample_key(mask)
+            shape = data.shape
+
+        dtype = data.dtype.str
+        transformed = np.empty(shape, dtype=data.dtype)
+        missing = []
+        for position, variable_key in enumerate(variable_keys):
+            cached = self.get((variable_key, kind, sample, dtype))
+            if cached is None:
+                missing.append(position)
+            else:
+                transformed[..., position] = cached
+
+        if missing:
+            subset = data[..., missing]
+            if kind == 'fd':
+                computed = first_difference(subset, lag, order)
+            elif kind == 'twoway':
+                computed = twoway_demean(subset, mask)
+            else:
+                computed = entity_demean(subset, mask)
+
+            for column, position in enumerate(missing):
+                transformed[..., position] = computed[..., column]
+                self.put((variable_keys[position], kind, sample, dtype), np.ascontiguousarray(computed[..., column]))
+
+        return transformed
+
+
+TRANSFORM_CACHE = TransformCache()  # shared by all estimators created with cache=True
@@ -0,0 +1,332 @@
+"""
+Array transforms for panel data
+All functions work on a contiguous (entities * times * variables) float array,
+missing cells are NaN
+float32 arrays stay float32, their sums and means are accumulated in float64
+
+A utility for the FE/FD classes
+"""
+
+import warnings
+
+import numpy as np
+
+
+def valid_mask(data):
+    """
+    Find the cells where every variable is observed
+    :param data: 3D numpy array (entities * times * variables)
+    :return: 2D boolean array (entities * times)
+    """
+
+    return np.isfinite(data).all(axis=2)
+
+
+def masked_sums(data, mask=None):
+    """
+    Zero out invalid cells and compute entity, time and grand sums in batched reductions
+    :param data: 3D numpy array (entities * times * variables)
+    :param mask: 2D boolean array of valid cells, computed from data if not supplied
+    :return: tuple of (filled data, mask, entity sums, entity counts, time sums, time counts)
+    """
+
+    if mask is None:
+        mask = valid_mask(data)
+
+    filled = np.where(mask[:, :, np.newaxis], data, data.dtype.type(0))  # the only full copy of the data
+
+    entity_sums = filled.sum(axis=1, dtype=np.float64)  # entities * variables
+    entity_counts = mask.sum(axis=1)  # entities
+    time_sums = filled.sum(axis=0, dtype=np.float64)  # times * variables
+    time_counts = mask.sum(axis=0)  # times
+
+    return filled, mask, entity_sums, entity_counts, time_sums, time_counts
+
+
+def _safe_divide(sums, counts):
+    """
+    Divide sums by counts, groups with no observations get a zero mean
+    :param sums: 2D array (groups * variables)
+    :param counts: 1D array of group sizes
+    :return: 2D array of means
+    """
+
+    return sums / np.maximum(counts, 1)[:, np.newaxis]
+
+
+def entity_demean(data, mask=None):
+    """
+    Subtract entity means from all variables at once
+    Means are computed over the cells where all variables are observed, so that
+    every variable is demeaned on the same sample that enters the regression
+    :param data: 3D numpy array (entities * times * variables)
+    :param mask: 2D boolean array of valid cells, computed from data if not supplied
+    :return: 3D numpy array of demeaned data, NaN in invalid cells
+    """
+
+    filled, mask, entity_sums, entity_counts, _, _ = masked_sums(data, mask)
+
+    filled -= _safe_divide(entity_sums, entity_counts)[:, np.newaxis, :]
+    filled[~mask] = np.nan
+
+    return filled
+
+
+def twoway_demean(data, mask=None, time_sums=None, time_counts=None):
+    """
+    Subtract entity and time means and add back the grand mean for all variables at once
+    This is the one-shot twoway transform, exact for balanced panels only
+    :param data: 3D numpy array (entities * times * variables)
+    :param mask: 2D boolean array of valid cells, computed from data if not supplied
+    :param time_sums: 2D array (times * variables) of the time sums of the whole panel when data is a block of its
+    entities, together with time_counts; the time and grand means then come from the whole panel
+    :param time_counts: 1D array of the valid cells per period of the whole panel
+    :return: 3D numpy array of demeaned data, NaN in invalid cells
+    """
+
+    if time_sums is None:
+        filled, mask, entity_sums, entity_counts, time_sums, time_counts = masked_sums(data, mask)
+        grand_mean = entity_sums.sum(axis=0) / max(entity_counts.sum(), 1)
+    else:
+        filled, mask, entity_sums, entity_counts, _, _ = masked_sums(data, mask)
+        grand_mean = time_sums.sum(axis=0) / max(time_counts.sum(), 1)
+
+    filled -= _safe_divide(entity_sums, entity_counts)[:, np.newaxis, :]
+    filled -= _safe_divide(time_sums, time_counts)[np.newaxis, :, :]
+    filled += grand_mean
+    filled[~mask] = np.nan
+
+    return filled
+
+
+class GroupIndex(object):
+    def __init__(self, codes, n_groups=None):
+        """
+        Precomputed index of one grouping dimension over a set of observations
+        :param codes: 1D array of integer group codes (0..n_groups-1), one per observation
+        :param n_groups: number of groups, inferred from codes if not supplied
+        :return: nothing
+        """
+
+        self.codes = np.asarray(codes, dtype=np.intp)
+        self.n_groups = int(self.codes.max()) + 1 if n_groups is None else n_groups
+        self.counts = np.bincount(self.codes, minlength=self.n_groups)
+
+        self._flat = None  # flattened (observation, variable) -> (group, variable) index, built on first use
+
+    def flat_index(self, k):
+        """
+        Index of each (observation, variable) cell into a flattened (groups * variables) array
+        :param k: number of variables
+        :return: 1D integer array of length observations * k
+        """
+
+        if self._flat is None or self._flat.shape[0] != self.codes.shape[0] * k:
+            self._flat = (self.codes[:, np.newaxis] * k + np.arange(k)).ravel()
+        return self._flat
+
+    def means(self, values):
+        """
+        Group means of all variables in a single bincount
+        :param values: 2D array (observations * variables)
+        :return: 2D array (groups * variables)
+        """
+
+        k = values.shape[1]
+        sums = np.bincount(self.flat_index(k), weights=values.ravel(), minlength=self.n_groups * k)
+        return _safe_divide(sums.reshape(self.n_groups, k), self.counts)
+
+
+def absorb(values, groups, tol=1e-8, maxiter=1000, accelerate=True):
+    """
+    Remove any number of fixed effects by alternating projections
+    Each sweep demeans the values within every grouping dimension in turn, sweeps are
+    repeated until the values stop changing, optionally with Irons-Tuck acceleration
+    Exact for unbalanced data, a single dimension converges in one sweep
+    :param values: 2D array (observations * variables) with no missing values
+    :param groups: list of GroupIndex, one per absorbed dimension
+    :param tol: convergence tolerance on the largest change, relative to the scale of each variable
+    :param maxiter: maximum number of sweeps
+    :param accelerate: whether to use Irons-Tuck extrapolation every other sweep
+    :return: tuple of (2D array of residualized values, number of sweeps)
+    """
+
+    def sweep(current):
+        swept = current.copy()
+        for group in groups:
+            swept -= group.means(swept)[group.codes]
+        return swept
+
+    current = np.array(values, dtype=np.float64)  # sweeps run in float64 even for float32 data, to converge to tol
+    scale = np.maximum(np.abs(current).max(axis=0), 1.) if current.shape[0] else np.ones(current.shape[1])
+
+    if len(groups) == 1:
+        return sweep(current), 1
+
+    iterations = 0
+    while iterations < maxiter:
+        updated = sweep(current)
+        iterations += 1
+
+        if accelerate:
+            swept_twice = sweep(updated)
+            iterations += 1
+            step = swept_twice - updated
+            curvature = step - (updated - current)
+            denominator = (curvature * curvature).sum(axis=0)
+            coefficient = np.where(denominator > 0, (step * curvature).sum(axis=0) / np.where(denominator > 0, denominator, 1.), 0.)
+            updated = swept_twice - coefficient * step
+
+        change = np.abs(updated - current).max(axis=0) if current.shape[0] else np.zeros(current.shape[1])
+        current = updated
+        if (change <= tol * scale).all():
+            break
+    else:
+        warnings.warn('alternating projections did not converge to tol=%g in %d sweeps' % (tol, maxiter), RuntimeWarning)
+
+    return current, iterations
+
+
+def _nested(inner, outer):
+    """
+    Whether every group of one dimension lies within a single group of another
+    :param inner: GroupIndex over the observations
+    :param outer: GroupIndex over the same observations
+    :return: bool
+    """
+
+    pairs = np.unique(inner.codes * outer.n_groups + outer.codes)
+    return pairs.shape[0] == int((inner.counts > 0).sum())
+
+
+def _components(first, second):
+    """
+    Connected components of the bipartite graph linking the groups of two dimensions that share observations
+    :param first: GroupIndex over the observations
+    :param second: GroupIndex over the same observations
+    :return: number of components among the observed groups
+    """
+
+    from scipy import sparse
+    from scipy.sparse.csgraph import connected_components
+
+    n_first = first.n_groups
+    n_nodes = n_first + second.n_groups
+    edges = sparse.coo_matrix((np.ones(first.codes.shape[0]), (first.codes, n_first + second.codes)), shape=(n_nodes, n_nodes))
+    _, labels = connected_components(edges, directed=False)
+
+    observed = np.concatenate([first.counts > 0, second.counts > 0])
+    return np.unique(labels[observed]).shape[0]
+
+
+def absorbed_counts(groups):
+    """
+    Number of linearly independent effects every absorbed dimension adds, in order
+    A dimension that is a union of the groups of another one (e.g. years given industry * year) adds none;
+    the others lose one effect per connected component they form with an earlier dimension, the most
+    components of any earlier dimension, which is exact for two dimensions and for nested ones
+    :param groups: list of GroupIndex over the same observations, the first one counts all its observed groups
+    :return: list of integer counts, one per dimension
+    """
+
+    redundant = [position > 0 and any(_nested(other, group) and (other_position < position or not _nested(group, other))
+                                      for other_position, other in enumerate(groups) if other_position != position)
+                 for position, group in enumerate(groups)]
+
+    counts = []
+    for position, group in enumerate(groups):
+        observed = int((group.counts > 0).sum())
+        if position == 0:
+            counts.append(observed)
+        elif redundant[position]:
+            counts.append(0)
+        else:
+            earlier = [_components(other, group) for other_position, other in enumerate(groups[:position])
+                       if not redundant[other_position]]
+            counts.append(observed - max(earlier))
+    return counts
+
+
+def _difference_weights(order):
+    """
+    Binomial weights of a difference of some order, (1 - L)^order = sum_j weight_j L^j
+    :param order: order of the difference
+    :return: list of integer weights, for lags 0 .. order
+    """
+
+    weights = [1]
+    for _ in range(order):
+        weights = [a - b for a, b in zip(weights + [0], [0] + weights)]
+    return weights
+
+
+def first_difference(data, lag=1, order=1, out=None):
+    """
+    Differences of all variables at once along the time axis of a dense array
+    y_t - y_(t-lag), applied order times; lag > 1 gives seasonal differences
+    A missing period makes every difference that spans it NaN, nothing is differenced across a gap
+    :param data: 3D numpy array (entities * times * variables)
+    :param lag: number of periods to difference over
+    :param order: number of times to difference
+    :param out: optional preallocated contiguous array (entities * (times - lag * order) * variables)
+    :return: 3D array (entities * (times - lag * order) * variables), out if supplied
+    """
+
+    assert lag >= 1 and order >= 1
+
+    span = lag * order
+    shape = (data.shape[0], data.shape[1] - span) + data.shape[2:]
+    assert shape[1] > 0
+
+    if out is None:
+        out = np.empty(shape, dtype=data.dtype)
+    assert out.shape == shape
+
+    if order == 1:
+        # the common case is a single strided subtraction
+        return np.subtract(data[:, lag:], data[:, :-lag], out=out)
+
+    weights = _difference_weights(order)
+    np.copyto(out, data[:, span:])
+    for j, weight in enumerate(weights[1:], 1):
+        start = span - j * lag
+        if weight == -1:
+            out -= data[:, start:start + shape[1]]
+        elif weight == 1:
+            out += data[:, start:start + shape[1]]
+        else:
+            out += weight * data[:, start:start + shape[1]]
+    return out
+
+
+def long_first_difference(values, entity_codes, time_codes, lag=1, order=1):
+    """
+    Gap-aware first differences of long-format rows sorted by entity and time
+    A row is differenced only against the same entity exactly `lag` periods earlier,
+    otherwise (first period, gap in the entity's history) the difference is NaN
+    Time codes index the panel's periods, so a period missing for every entity is not seen as a gap
+    :param values: 2D array (rows * variables)
+    :param entity_codes: 1D integer array of entity codes per row
+    :param time_codes: 1D integer array of time codes per row
+    :param lag: number of periods to difference over
+    :param order: number of times to difference
+    :return: 2D array (rows * variables)
+    """
+
+    differenced = np.array(values, dtype=values.dtype)
+    if values.shape[0] == 0:
+        return differenced
+
+    # the row `lag` periods earlier, if observed, is found by a sorted search on (entity, time)
+    keys = entity_codes.astype(np.int64) * (int(time_codes.max()) + lag + 1) + time_codes
+    wanted = keys - lag
+    previous = np.searchsorted(keys, wanted)
+    found = (time_codes >= lag) & (previous < len(keys))
+    found[found] &= keys[previous[found]] == wanted[found]
+    previous = previous[found]
+
+    for _ in range(order):
+        lagged = differenced[previous]
+        differenced[~found] = np.nan
+        differenced[found] -= lagged
+    return differenced